@@ -8,8 +8,8 @@ from typing import TypedDict, Any, Type
 
 from aiogram import Bot, Dispatcher, F, html
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.scene import After, Scene, SceneRegistry, on, SceneWizard, FSMContext
-from aiogram.methods import SendMessage
 from aiogram.types import (
     CallbackQuery,
     InlineKeyboardButton,
@@ -20,7 +20,7 @@ from aiogram.types import (
     ReplyKeyboardRemove,
 )
 
-from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 
 from aiogram.utils.formatting import (
     Bold,
@@ -35,19 +35,27 @@ from aiogram.filters.state import State, StatesGroup
 
 import errors
 from database import (
-    get_all_users, get_active_user, save_user, active_user,
+    get_users_page, approximate_user_count, UsersPage, get_active_user, save_user, active_user,
     add_user_command, remove_user_command, CommandSearch, my_search_commands,
     is_user_command_exist, get_user_command, update_user
 )
+import bootstrap
+import callbacks
+import profiling
+from bootstrap import create_bot
+from middlewares import DbStatsMiddleware, HandlerMetricsMiddleware, ProfilerMiddleware, UpdatesInFlightMiddleware
+from storage import create_storage
+from webhook import run_webhook
+
+logger = logging.getLogger(__name__)
 
 BUTTON_CANCEL = KeyboardButton(text="❌ Cancel")
 BUTTON_BACK = KeyboardButton(text="🔙 Back")
 BUTTON_STOP_COMMAND = KeyboardButton(text="✋ Stop ⏹")
 
 import settings
-from main import search_google, mobile_agent, desktop_agent
-
-bot = Bot(settings.TELEGRAM_API)
+from search import search_profiles, quota_exceeded_text
+from results import ProgressiveReply
 
 basic_commands = [
     "/cari",
@@ -91,40 +99,73 @@ class VerifyScene(Scene, state="verify_state"):
     async def input_like_bots(self, message: Message):
         await message.answer("Mengecek Kode . . .")
         try:
-            active_user(message.from_user.id, message.text)
+            await active_user(message.from_user.id, message.text)
             await message.answer("Kode benar 🥳")
             await self.wizard.goto(MainScene)
         except errors.VerifyCodeWrong as e:
             await message.answer("Kode salah, silahkan masukkan lagi : ")
 
 
+class UserPageCallback(CallbackData, prefix="users"):
+    cursor: int
+    backward: bool
+    offset: int
+
+
+async def user_page_content(page: UsersPage, offset: int):
+    total = await approximate_user_count()
+    content = as_section(
+        Bold(f"Daftar Pengguna Saat ini (±{total}):\n"),
+        as_numbered_list(*page.users, start=offset + 1),
+    )
+    builder = InlineKeyboardBuilder()
+    if page.has_prev:
+        builder.button(
+            text="⬅️ Prev",
+            callback_data=UserPageCallback(
+                cursor=page.first_id, backward=True, offset=max(offset - settings.USER_PAGE_SIZE, 0)
+            ),
+        )
+    if page.has_next:
+        builder.button(
+            text="Next ➡️",
+            callback_data=UserPageCallback(cursor=page.last_id, backward=False, offset=offset + len(page.users)),
+        )
+    return content, builder.as_markup()
+
+
 class UserListScene(Scene, state="user_list_state"):
 
     @on.message.enter()
     async def on_enter(self, message: Message):
         try:
-            get_active_user(message.from_user.id)
+            await get_active_user(message.from_user.id)
         except Exception as _:
             await self.wizard.goto(DefaultScene)
+            return
         await message.answer("Mengambil daftar pengguna . . . ")
-        all_user = get_all_users()
-        if len(all_user) == 0:
+        page = await get_users_page()
+        if len(page.users) == 0:
             await message.answer("masih belum ada pengguna :( ")
             return
-        content = as_list(
-            as_section(
-                Bold("Daftar Pengguna Saat ini:\n"),
-                as_numbered_list(*all_user),
-            ),
-            "\nSilahkan pilih action"
-        )
+        content, page_markup = await user_page_content(page, offset=0)
+        await message.answer(**content.as_kwargs(), reply_markup=page_markup)
 
         markup = ReplyKeyboardBuilder()
         markup.button(text="Delete")
         markup.button(text="Blacklist")
         markup.button(text="🔙 Back")
         await self.wizard.update_data(command="/daftar_pengguna")
-        await message.answer(**content.as_kwargs(), reply_markup = markup.adjust(2).as_markup(resize_keyboard=True))
+        await message.answer("Silahkan pilih action", reply_markup=markup.adjust(2).as_markup(resize_keyboard=True))
+
+    @on.callback_query(UserPageCallback.filter())
+    async def change_page(self, callback_query: CallbackQuery, callback_data: UserPageCallback):
+        page = await get_users_page(callback_data.cursor, backward=callback_data.backward)
+        await callback_query.answer()
+        if len(page.users) == 0:
+            return
+        content, page_markup = await user_page_content(page, offset=callback_data.offset)
+        await callback_query.message.edit_text(**content.as_kwargs(), reply_markup=page_markup)
 
     @on.message(F.text == "🔙 Back")
     async def back(self, message: Message) -> None:
@@ -191,7 +232,7 @@ class RemoveCommandScene(Scene, state="remove_command_state"):
             await message.answer("Memeriksa Command sebelum di hapus . . .")
             answers["cmd"] = message.text
             try:
-                exist = is_user_command_exist(message.from_user.id, message.text)
+                exist = await is_user_command_exist(message.from_user.id, message.text)
                 if not exist:
                     await message.answer("command ini tidak ada")
                     return
@@ -202,7 +243,7 @@ class RemoveCommandScene(Scene, state="remove_command_state"):
             if message.text == "🗑 Hapus":
                 await message.answer("Sedang menghapus . .")
                 try:
-                    remove_user_command(message.from_user.id, answers["cmd"])
+                    await remove_user_command(message.from_user.id, answers["cmd"])
                     await message.answer("Berhasil Menghapus")
                     return await self.wizard.goto(MainScene)
                 except Exception as e:
@@ -211,14 +252,20 @@ class RemoveCommandScene(Scene, state="remove_command_state"):
             else:
                 await message.answer("jawaban tidak di ketahui")
             return
-        print(step)
         await state.update_data(answers=answers)
         await self.wizard.retake(step=step + 1)
 
 
+def schedule_text(schedule_minutes: int | None) -> str:
+    if not schedule_minutes:
+        return "-"
+    return f"setiap {schedule_minutes // 60} jam"
+
+
 @dataclass
 class Question:
     text: str
+    optional: bool = False
 
 
 class AddCommandScene(Scene, state="add_command_state"):
@@ -233,6 +280,11 @@ class AddCommandScene(Scene, state="add_command_state"):
             ),
             Question(
                 text="Masukkan deskripsi (boleh kosong) : ",
+                optional=True,
+            ),
+            Question(
+                text="Cari otomatis setiap berapa jam? Link baru akan dikirim ke sini (boleh kosong) : ",
+                optional=True,
             ),
         ]
 
@@ -245,7 +297,7 @@ class AddCommandScene(Scene, state="add_command_state"):
             if step < max_step:
                 if step > 0:
                     markup.button(text="🔙 Back")
-                if step + 1 == max_step:
+                if self.QUESTIONS[step].optional:
                     markup.button(text="➡️ Skip")
                 markup.button(text="🚫 Cancel")
                 return await message.answer(
@@ -265,6 +317,7 @@ class AddCommandScene(Scene, state="add_command_state"):
                             f"Perintah \t\t\t: {answers['cmd']}",
                             f"Keyword \t\t\t: {answers['keyword']}",
                             f"Description \t: {answers['desc']}",
+                            f"Jadwal \t\t\t: {schedule_text(answers['schedule_minutes'])}",
                         ]),
                     ),
                     "",
@@ -274,8 +327,8 @@ class AddCommandScene(Scene, state="add_command_state"):
                     **content.as_kwargs(),
                     reply_markup=markup.adjust(2).as_markup(resize_keyboard=True),
                 )
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("could not show the add command step")
             return await self.wizard.goto(MainScene)
 
     @on.message(F.text == "🔙 Back")
@@ -314,7 +367,7 @@ class AddCommandScene(Scene, state="add_command_state"):
                 if cmd == message.text.lower():
                     await message.answer("tidak boleh menggunakan perintah ini")
                     return
-            if is_user_command_exist(message.from_user.id, message.text):
+            if await is_user_command_exist(message.from_user.id, message.text):
                 await message.answer("command ini sudah ada, gunakan command lain")
                 return
             answers["cmd"] = message.text
@@ -324,6 +377,14 @@ class AddCommandScene(Scene, state="add_command_state"):
             answers["desc"] = message.text
             if message.text == "➡️ Skip":
                 answers["desc"] = None
+        elif step == 3:
+            answers["schedule_minutes"] = None
+            if message.text != "➡️ Skip":
+                min_hours = settings.SCHEDULER_MIN_MINUTES // 60 or 1
+                if not message.text.isdigit() or int(message.text) < min_hours:
+                    await message.answer(f"masukkan jumlah jam, minimal {min_hours}")
+                    return
+                answers["schedule_minutes"] = int(message.text) * 60
         else:
             if message.text == "📔 Save":
                 try:
@@ -331,7 +392,8 @@ class AddCommandScene(Scene, state="add_command_state"):
                     cmd.command = answers["cmd"]
                     cmd.keyword = answers["keyword"]
                     cmd.desc = answers["desc"]
-                    add_user_command(message.from_user.id, cmd)
+                    cmd.schedule_minutes = answers["schedule_minutes"]
+                    await add_user_command(message.from_user.id, cmd)
                     await message.answer("Sukses menambah perintah baru")
                     await self.wizard.goto(MainScene)
                     return
@@ -371,30 +433,16 @@ class SearchScene(Scene, state="search_state"):
     @on.message()
     async def input_search_keyword(self, message: Message):
         try:
-            get_active_user(message.from_user.id)
-            await message.answer("Mencari . . .")
-            mobile_search_result = await search_google(message.text, mobile_agent)
-            desktop_search_result = await search_google(message.text, desktop_agent)
-            if not mobile_search_result and not mobile_search_result:
-                await message.answer("Tidak ada hasil ")
+            await get_active_user(message.from_user.id)
+            # Plain text only: Telegram does not edit messages that carry a reply keyboard.
+            placeholder = await message.answer("Mencari . . .")
+            reply = ProgressiveReply(placeholder, message.text, message.from_user.id)
+            try:
+                results = await search_profiles(message.text, user_id=message.from_user.id, on_progress=reply.update)
+            except errors.QuotaExceeded as e:
+                await reply.finish_text(quota_exceeded_text(e))
                 return
-
-            content = as_list(
-                as_section(
-                    Bold("Mobile Result:\n"),
-                    as_numbered_list(*mobile_search_result),
-                ),
-                "",
-                as_section(
-                    Bold("Desktop Result:\n"),
-                    as_numbered_list(*desktop_search_result),
-                ),
-                "",
-            )
-            await message.answer(**content.as_kwargs(), reply_markup=ReplyKeyboardMarkup(
-                keyboard=[[BUTTON_STOP_COMMAND]],
-                resize_keyboard=True,
-            ), )
+            await reply.finish(results)
         except errors.VerifyCodeWrong as e:
             await self.wizard.goto(VerifyScene)
 
@@ -403,7 +451,7 @@ class MainScene(CancellableScene, state="code"):
 
     @on.message.enter()  # Marker for handler that should be called when a user enters the scene.
     async def on_enter(self, message: Message):
-        my_commands = my_search_commands(telegram_id=message.from_user.id)
+        my_commands = await my_search_commands(telegram_id=message.from_user.id)
         content = [
             as_section(
                 Bold("Perintah Dasar:\n"),
@@ -426,7 +474,7 @@ class MainScene(CancellableScene, state="code"):
         # )
         content.append("\nSilahkan pilih perintah")
         try:
-            get_active_user(message.from_user.id)
+            await get_active_user(message.from_user.id)
             await message.answer(**as_list(*content).as_kwargs(), reply_markup=ReplyKeyboardRemove())
         except Exception as _:
             await self.wizard.back()
@@ -434,7 +482,7 @@ class MainScene(CancellableScene, state="code"):
     @on.message(F.text.casefold() == "/cari")
     async def handle_cari(self, message: Message):
         try:
-            get_active_user(message.from_user.id)
+            await get_active_user(message.from_user.id)
             await self.wizard.goto(SearchScene)
         except Exception as _:
             await self.wizard.goto(DefaultScene)
@@ -446,7 +494,7 @@ class MainScene(CancellableScene, state="code"):
     @on.message(F.text.casefold() == "/tambah_perintah")
     async def tambah_perintah(self, message: Message):
         try:
-            get_active_user(message.from_user.id)
+            await get_active_user(message.from_user.id)
             await self.wizard.goto(AddCommandScene)
         except Exception as _:
             await self.wizard.goto(DefaultScene)
@@ -454,7 +502,7 @@ class MainScene(CancellableScene, state="code"):
     @on.message(F.text.casefold() == "/hapus_perintah")
     async def hapus_perintah(self, message: Message):
         try:
-            get_active_user(message.from_user.id)
+            await get_active_user(message.from_user.id)
             await self.wizard.goto(RemoveCommandScene)
         except Exception as _:
             await self.wizard.goto(DefaultScene)
@@ -462,7 +510,7 @@ class MainScene(CancellableScene, state="code"):
     @on.message(F.text.casefold() == "/daftar_pengguna")
     async def daftar_pengguna_perintah(self, message: Message):
         try:
-            get_active_user(message.from_user.id)
+            await get_active_user(message.from_user.id)
             await self.wizard.goto(UserListScene)
         except Exception as _:
             await self.wizard.goto(DefaultScene)
@@ -477,7 +525,7 @@ class MainScene(CancellableScene, state="code"):
         cmd: Type[CommandSearch] | None = None
         if message.text[0] == "/":
             try:
-                cmd = get_user_command(message.from_user.id, message.text)
+                cmd = await get_user_command(message.from_user.id, message.text)
             except Exception as e:
                 await message.answer(f"Error : {e}")
                 return
@@ -487,27 +535,15 @@ class MainScene(CancellableScene, state="code"):
             return
 
         try:
-            get_active_user(message.from_user.id)
-            await message.answer("Mencari . . .")
-            mobile_search_result = await search_google(cmd.keyword, mobile_agent)
-            desktop_search_result = await search_google(cmd.keyword, desktop_agent)
-            if not mobile_search_result and not mobile_search_result:
-                await message.answer("Tidak ada hasil ")
+            await get_active_user(message.from_user.id)
+            placeholder = await message.answer("Mencari . . .")
+            reply = ProgressiveReply(placeholder, cmd.keyword, message.from_user.id)
+            try:
+                results = await search_profiles(cmd.keyword, user_id=message.from_user.id, on_progress=reply.update)
+            except errors.QuotaExceeded as e:
+                await reply.finish_text(quota_exceeded_text(e))
                 return
-
-            content = as_list(
-                as_section(
-                    Bold("Mobile Result:\n"),
-                    as_numbered_list(*mobile_search_result),
-                ),
-                "",
-                as_section(
-                    Bold("Desktop Result:\n"),
-                    as_numbered_list(*desktop_search_result),
-                ),
-                "",
-            )
-            await message.answer(**content.as_kwargs(), reply_markup=ReplyKeyboardRemove())
+            await reply.finish(results)
         except errors.VerifyCodeWrong as e:
             await self.wizard.goto(VerifyScene)
 
@@ -552,14 +588,13 @@ class DefaultScene(
             )
             return
         try:
-            update_user(message.from_user.id, message.from_user.full_name, message.from_user.username)
+            await update_user(message.from_user.id, message.from_user.full_name, message.from_user.username)
             await self.wizard.goto(MainScene)
         except errors.UserNotFound as e:
             confirm_code = str(uuid4())
             confirm_code = confirm_code.replace("-", "")
-            save_user(message.from_user.id, message.from_user.full_name, message.from_user.username, confirm_code)
-            await bot(SendMessage(chat_id=settings.ADMIN_USER_ID,
-                                  text=f"this is code for @{message.from_user.username}\n{confirm_code}"))
+            await save_user(message.from_user.id, message.from_user.full_name, message.from_user.username, confirm_code,
+                            admin_text=f"this is code for @{message.from_user.username}\n{confirm_code}")
             await message.answer(
                 f"Selamat Datang {message.from_user.full_name} :) ", reply_markup=ReplyKeyboardRemove()
             )
@@ -572,7 +607,18 @@ class DefaultScene(
 
 
 def create_dispatcher() -> Dispatcher:
-    dispatcher = Dispatcher()
+    storage = create_storage()
+    dispatcher = Dispatcher(storage=storage)
+    dispatcher.update.outer_middleware(UpdatesInFlightMiddleware())
+    dispatcher.update.outer_middleware(DbStatsMiddleware())
+    # Inner middlewares of the dispatcher also run for the handlers of the scenes.
+    for observer in (dispatcher.message, dispatcher.callback_query):
+        observer.middleware(HandlerMetricsMiddleware())
+        observer.middleware(ProfilerMiddleware())
+    bootstrap.setup(dispatcher)
+    # Before the scenes, which would otherwise take the callback queries first.
+    dispatcher.include_router(callbacks.create_router())
+    dispatcher.include_router(profiling.create_router())
 
     # Scene registry should be the only one instance in your application for proper work.
     # It stores all available scenes.
@@ -588,17 +634,25 @@ def create_dispatcher() -> Dispatcher:
         RemoveCommandScene,
         UserListScene
     )
+    # After the scenes, for buttons none of them handled.
+    dispatcher.include_router(callbacks.create_expired_router())
 
     return dispatcher
 
 
 async def main():
     dispatcher = create_dispatcher()
+    bot = create_bot()
+    # Telegram refuses getUpdates while a webhook is set.
+    await bot.delete_webhook()
     await dispatcher.start_polling(bot)
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
+    if settings.BOT_MODE == "webhook":
+        run_webhook(create_dispatcher, create_bot)
+    else:
+        asyncio.run(main())
     # Alternatively, you can use aiogram-cli:
     # `aiogram run polling quiz_scene:create_dispatcher --log-level info --token BOT_TOKEN`
@@ -0,0 +1,56 @@
+"""
+Cold start time of the bot process.
+
+Starts fresh interpreters, like a new container would, and measures how long it takes to import
+baru.py and build the dispatcher. Connecting to the database and the other startup phases are
+logged by bootstrap.on_startup on every real start and are not repeated here.
+
+    python benchmarks/bench_startup.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, time
+started = time.perf_counter()
+import baru
+imported = time.perf_counter()
+baru.create_dispatcher()
+print(json.dumps({"import": imported - started, "dispatcher": time.perf_counter() - imported}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    import settings
+
+    samples = {"import": [], "dispatcher": [], "process": []}
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE], cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout
+        samples["process"].append(time.perf_counter() - started)
+        for name, seconds in json.loads(output.strip().splitlines()[-1]).items():
+            samples[name].append(seconds)
+
+    for name, values in samples.items():
+        print(f"{name:>10}: median {statistics.median(values) * 1000:.0f}ms, max {max(values) * 1000:.0f}ms")
+    worst = max(samples["process"])
+    verdict = "within" if worst <= settings.STARTUP_BUDGET else "OVER"
+    print(f"worst cold start {worst:.2f}s is {verdict} the {settings.STARTUP_BUDGET:.2f}s STARTUP_BUDGET")
+
+
+if __name__ == "__main__":
+    main()
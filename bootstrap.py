@@ -0,0 +1,103 @@
+"""
+Application bootstrap.
+
+Importing the bot modules has no side effects: the database engine, the HTTP client and the bot
+are created here, when the dispatcher starts. Every startup phase is timed and the total is checked
+against STARTUP_BUDGET. `ready` is set once updates can be served.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from aiogram import Bot, Dispatcher
+
+import settings
+from cachesync import start_cache_sync, stop_cache_sync
+from database import close_db, wait_for_db, warm_command_index
+from metrics import start_metrics_server, stop_metrics_server
+from migrations import migrate
+from outbox import start_outbox, stop_outbox
+from profiling import profiler
+from scheduler import start_scheduler, stop_scheduler
+from search import close_http_client, start_http_client
+from throttling import install_throttle
+
+logger = logging.getLogger(__name__)
+
+ready = asyncio.Event()
+startup_timings: dict[str, float] = {}
+
+
+def create_bot() -> Bot:
+    bot = Bot(settings.TELEGRAM_API)
+    if settings.SEND_THROTTLE:
+        install_throttle(bot)
+    return bot
+
+
+def is_ready() -> bool:
+    return ready.is_set()
+
+
+@asynccontextmanager
+async def _phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+
+async def on_startup(bot: Bot):
+    started = time.perf_counter()
+    async with _phase("database"):
+        await wait_for_db()
+    if settings.DB_AUTO_MIGRATE:
+        async with _phase("migrations"):
+            await migrate()
+    async with _phase("command index"):
+        await warm_command_index()
+    async with _phase("http client"):
+        await start_http_client()
+    if settings.BOT_MODE != "webhook":
+        async with _phase("metrics server"):
+            await start_metrics_server()
+    total = time.perf_counter() - started
+
+    phases = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in startup_timings.items())
+    if total > settings.STARTUP_BUDGET:
+        logger.warning("startup took %.2fs, over the %.2fs budget (%s)", total, settings.STARTUP_BUDGET, phases)
+    else:
+        logger.info("startup took %.2fs (%s)", total, phases)
+
+    ready.set()
+    if settings.READY_FILE:
+        with open(settings.READY_FILE, "w") as ready_file:
+            ready_file.write(str(os.getpid()))
+    start_cache_sync()
+    start_scheduler(bot)
+    start_outbox(bot)
+    if settings.PROFILER_ENABLED:
+        profiler.enable()
+
+
+async def on_shutdown():
+    ready.clear()
+    if settings.READY_FILE and os.path.exists(settings.READY_FILE):
+        os.remove(settings.READY_FILE)
+    await stop_scheduler()
+    await stop_outbox()
+    await stop_cache_sync()
+    profiler.disable()
+    await close_http_client()
+    await stop_metrics_server()
+    await close_db()
+
+
+def setup(dispatcher: Dispatcher):
+    dispatcher.startup.register(on_startup)
+    # Shutdown hooks run in registration order; the FSM storage must flush before the engine closes.
+    dispatcher.shutdown.register(dispatcher.storage.close)
+    dispatcher.shutdown.register(on_shutdown)
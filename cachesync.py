@@ -0,0 +1,83 @@
+"""
+Keeps the per-process caches of database.py (auth_cache, command_index) in line across bot processes.
+
+Every change to a user or their saved commands writes a `cache_invalidation` row in the same
+transaction. Each process polls the table every CACHE_SYNC_INTERVAL seconds and drops the users
+changed since its last poll, so a command added through one webhook worker is known to the
+others within about a second instead of after COMMAND_INDEX_TTL.
+
+Rows are read again for CACHE_SYNC_SLACK seconds, because a transaction can commit a little after
+the time it wrote into `created_at`, and are deleted once no cache can still hold what they replaced.
+"""
+import asyncio
+import logging
+import time
+
+import settings
+from database import cache_invalidations_since, forget_user, purge_cache_invalidations
+
+logger = logging.getLogger(__name__)
+
+
+class CacheSync:
+    def __init__(self, interval: float = settings.CACHE_SYNC_INTERVAL):
+        self.interval = interval
+        self.retention = int(max(settings.AUTH_CACHE_TTL, settings.COMMAND_INDEX_TTL)) + settings.CACHE_SYNC_SLACK
+        self._since = int(time.time())
+        self._purged_at = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop(), name="cache-sync")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("cache sync failed: %r", e)
+
+    async def poll(self) -> int:
+        """
+        Drop the users changed since the last poll from the caches, returns how many.
+        """
+        now = int(time.time())
+        changed = await cache_invalidations_since(self._since - settings.CACHE_SYNC_SLACK)
+        for telegram_id in changed:
+            forget_user(telegram_id)
+        self._since = now
+        if time.monotonic() - self._purged_at >= self.retention:
+            await purge_cache_invalidations(now - self.retention)
+            self._purged_at = time.monotonic()
+        return len(changed)
+
+
+cache_sync: CacheSync | None = None
+
+
+def start_cache_sync():
+    global cache_sync
+    if settings.CACHE_SYNC_INTERVAL <= 0:
+        return
+    cache_sync = CacheSync()
+    cache_sync.start()
+
+
+async def stop_cache_sync():
+    global cache_sync
+    if cache_sync is not None:
+        await cache_sync.stop()
+        cache_sync = None
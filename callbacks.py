@@ -0,0 +1,47 @@
+"""
+Inline keyboard callbacks that do not belong to a scene.
+
+The router of `create_router` is included in the dispatcher before the scenes, so the buttons
+keep working whatever scene the user is in. The one of `create_expired_router` goes after them and
+answers the buttons no scene took, e.g. the user list pager once the admin left UserListScene, so
+the client does not wait for an answer. A router can only be attached to one dispatcher, so every
+dispatcher gets new ones.
+"""
+from aiogram import Router
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery
+
+from results import ResultPage, load_results, result_page
+
+async def change_result_page(callback_query: CallbackQuery, callback_data: ResultPage):
+    stored = await load_results(callback_data.rid)
+    if stored is None:
+        await callback_query.answer("Hasil pencarian sudah kedaluwarsa, silahkan cari lagi", show_alert=True)
+        return
+    if stored.owner_id != callback_query.from_user.id:
+        await callback_query.answer()
+        return
+    content, markup = result_page(callback_data.rid, stored, callback_data.profile, callback_data.page)
+    await callback_query.answer()
+    try:
+        await callback_query.message.edit_text(**content.as_kwargs(), reply_markup=markup)
+    except TelegramBadRequest as e:
+        # A double tap asks for the page that is already shown.
+        if "message is not modified" not in str(e):
+            raise
+
+
+async def answer_expired(callback_query: CallbackQuery):
+    await callback_query.answer("Halaman sudah kedaluwarsa")
+
+
+def create_router() -> Router:
+    router = Router(name="callbacks")
+    router.callback_query.register(change_result_page, ResultPage.filter())
+    return router
+
+
+def create_expired_router() -> Router:
+    router = Router(name="expired-callbacks")
+    router.callback_query.register(answer_expired)
+    return router
@@ -1,13 +1,26 @@
-from typing import List, Type
+import asyncio
+import logging
+import secrets
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import List, AsyncIterator
 
 import settings
 import errors
+from cache import TTLCache
+from metrics import observe_db
 
-from sqlalchemy import create_engine, Column, Integer, String, Sequence, Boolean, ForeignKey, TEXT
+from sqlalchemy import event, BigInteger, Column, Integer, String, Sequence, Boolean, ForeignKey, TEXT, LargeBinary, Index, Select, select, update, delete, and_, func, text
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship, Mapped, mapped_column
+from sqlalchemy.orm import relationship, Mapped, mapped_column
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
+
+logger = logging.getLogger(__name__)
 
-DATABASE_URL = f'mysql+mysqlconnector://{settings.DB_USER}:{settings.DB_PASSWORD}@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}'
 Base = declarative_base()
 
 
@@ -34,135 +47,772 @@ class User(Base):
 
 class CommandSearch(Base):
     __tablename__ = 'command_search'
+    __table_args__ = (
+        Index("uq_command_search_user_command", "user_id", "command", unique=True),
+    )
     id = mapped_column(Integer, Sequence('cmd_search_id_seq'), primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"))
     user: Mapped["User"] = relationship(back_populates="command_search")
     command = Column(String(300))
     keyword = Column(TEXT)
     desc = Column(TEXT)
+    # Run the keyword in the background every `schedule_minutes`, None when not scheduled.
+    schedule_minutes = Column(Integer)
+    next_run_at = Column(Integer, index=True)
+    # Hashes of the links found by earlier runs, see scheduler.SeenLinks.
+    seen_links = Column(LargeBinary)
 
     def get_as_string(self) -> str:
-        result = f"{self.command}"
-        if self.desc:
-            result += f" = {self.desc}"
-        return result
+        return _command_label(self.command, self.desc, self.schedule_minutes)
 
 
-engine = create_engine(DATABASE_URL)
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-print("connected : ", DATABASE_URL)
+def _command_label(command: str, desc: str | None, schedule_minutes: int | None) -> str:
+    result = f"{command}"
+    if desc:
+        result += f" = {desc}"
+    if schedule_minutes:
+        result += f" (setiap {schedule_minutes // 60} jam)"
+    return result
 
 
-def save_user(telegram_id, fullname, username, verify_code):
-    session = Session()
-    user = User(telegram_id=telegram_id, fullname=fullname, verify_code=verify_code, username=username)
-    session.add(user)
-    session.commit()
-    session.close()
+@dataclass(frozen=True)
+class SavedCommand:
+    """
+    What command_index keeps of a CommandSearch. Not an ORM instance: a rollback of the session
+    that loaded one would expire it in the index.
+    """
+    command: str
+    keyword: str
+    desc: str | None
+    schedule_minutes: int | None
 
+    @classmethod
+    def of(cls, cmd: CommandSearch) -> "SavedCommand":
+        return cls(cmd.command, cmd.keyword, cmd.desc, cmd.schedule_minutes)
+
+    def get_as_string(self) -> str:
+        return _command_label(self.command, self.desc, self.schedule_minutes)
+
+
+class FsmState(Base):
+    """
+    Scene state and wizard data of one aiogram storage key, see storage.SQLStorage.
+    """
+    __tablename__ = 'fsm_state'
+    key = Column(String(255), primary_key=True)
+    state = Column(String(255))
+    data = Column(LargeBinary)
+    expires_at = Column(Integer, index=True)
+
+
+class AdminOutbox(Base):
+    """
+    Notification for the admin waiting to be delivered by outbox.OutboxWorker.
+    """
+    __tablename__ = 'admin_outbox'
+    id = mapped_column(Integer, Sequence('admin_outbox_id_seq'), primary_key=True)
+    text = Column(TEXT)
+    created_at = Column(Integer)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(Integer, index=True)
+    # Token of the worker delivering it, see claim_admin_notices.
+    claimed_by = Column(String(32))
+
+
+class SearchResult(Base):
+    """
+    Results of one search kept for paging, see results.py.
+    """
+    __tablename__ = 'search_result'
+    rid = Column(String(16), primary_key=True)
+    owner_id = Column(BigInteger)
+    data = Column(LargeBinary)
+    expires_at = Column(Integer, index=True)
+
+
+class SearchQuota(Base):
+    """
+    Google API calls made on one quota day, by the whole bot (user_id 0) and per user, see quota.py.
+    """
+    __tablename__ = 'search_quota'
+    day = Column(String(10), primary_key=True)
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    used = Column(Integer, nullable=False, default=0)
+
+
+class CacheInvalidation(Base):
+    """
+    A change to a user that every bot process has to drop from its caches, see cachesync.py.
+    """
+    __tablename__ = 'cache_invalidation'
+    id = mapped_column(Integer, Sequence('cache_invalidation_id_seq'), primary_key=True)
+    telegram_id = Column(BigInteger)
+    created_at = Column(Integer, index=True)
+
+
+_engine: AsyncEngine | None = None
+_sessionmaker: async_sessionmaker[AsyncSession] | None = None
+_fsm_engine: AsyncEngine | None = None
+
+
+def database_url() -> URL:
+    if settings.DATABASE_URL:
+        return make_url(settings.DATABASE_URL)
+    return URL.create(
+        "mysql+aiomysql",
+        username=settings.DB_USER,
+        password=settings.DB_PASSWORD,
+        host=settings.DB_HOST,
+        port=int(settings.DB_PORT) if settings.DB_PORT else None,
+        database=settings.DB_NAME,
+    )
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # Readers do not block the writer, and commits only sync the WAL at checkpoints.
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.DB_POOL_TIMEOUT * 1000)}")
+    cursor.close()
+
+
+def _is_memory(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def _create_engine(url: URL, pool_size: int, max_overflow: int) -> AsyncEngine:
+    """
+    Pooled engine for `url`. An in-memory SQLite database is the exception: every connection to
+    :memory: is a new empty database, so all sessions share a single connection, which serialises
+    queries and makes the pool settings meaningless. Use it for tests and benchmarks only.
+    """
+    if _is_memory(url):
+        logger.warning("using an in-memory SQLite database over a single connection, "
+                       "for tests only: queries run one at a time and nothing is kept")
+        engine = create_async_engine(url, poolclass=StaticPool)
+    elif url.get_backend_name() == "sqlite":
+        # aiosqlite defaults to NullPool, which opens the file and a thread for every session.
+        engine = create_async_engine(
+            url,
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+        )
+        event.listen(engine.sync_engine, "connect", _sqlite_pragmas)
+    else:
+        engine = create_async_engine(
+            url,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_pre_ping=settings.DB_POOL_PRE_PING,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
+
+
+def get_engine() -> AsyncEngine:
+    """
+    Create the engine on first use; creating it does not connect to the database yet.
+    """
+    global _engine, _sessionmaker
+    if _engine is None:
+        url = database_url()
+        _engine = _create_engine(url, settings.DB_POOL_SIZE, settings.DB_MAX_OVERFLOW)
+        _sessionmaker = async_sessionmaker(bind=_engine, expire_on_commit=False)
+        logger.info("database engine created for %s", url.render_as_string(hide_password=True))
+    return _engine
+
+
+def get_fsm_engine() -> AsyncEngine:
+    """
+    Engine of storage.SQLStorage. Its pool is separate from the one of the helpers, so an update
+    never holds a helper connection while it waits for a storage connection or the other way round.
+    """
+    global _fsm_engine
+    if _fsm_engine is None:
+        url = database_url()
+        if _is_memory(url):
+            # A second engine would open a second, empty database.
+            return get_engine()
+        _fsm_engine = _create_engine(url, settings.FSM_POOL_SIZE, settings.FSM_MAX_OVERFLOW)
+    return _fsm_engine
+
+
+def new_session() -> AsyncSession:
+    get_engine()
+    return _sessionmaker()
+
+
+async def wait_for_db(attempts: int = settings.DB_CONNECT_ATTEMPTS, delay: float = settings.DB_CONNECT_DELAY):
+    """
+    Retry until the database accepts connections, doubling the delay after every failure.
+    """
+    engine = get_engine()
+    for attempt in range(1, attempts + 1):
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            return
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            logger.warning("database is not reachable (attempt %d/%d): %s, retrying in %.1fs",
+                           attempt, attempts, e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.DB_CONNECT_MAX_DELAY)
+
+
+async def close_db():
+    global _engine, _sessionmaker, _fsm_engine
+    if _fsm_engine is not None:
+        await _fsm_engine.dispose()
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = None
+    _sessionmaker = None
+    _fsm_engine = None
+
+
+@dataclass
+class QueryStats:
+    queries: int = 0
+    seconds: float = 0.0
+
+
+# Set by middlewares.DbStatsMiddleware for the duration of one update.
+current_query_stats: ContextVar[QueryStats | None] = ContextVar("current_query_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    stats = current_query_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += time.perf_counter() - started
 
-def is_user_command_exist(telegram_id: int, cmd_str: str) -> bool:
-    session = Session()
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if user is None:
-        raise errors.UserNotFound()
-    if session.query(CommandSearch).filter_by(user_id=user.id, command=cmd_str).count():
-        return True
-    return False
 
+@asynccontextmanager
+async def _session() -> AsyncIterator[AsyncSession]:
+    """
+    One unit of work of a helper, on a short-lived session.
 
-def get_user_command(telegram_id: int, cmd_str: str) -> Type[CommandSearch] | None:
-    session = Session()
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if user is None:
-        raise errors.UserNotFound()
-    cmd = session.query(CommandSearch).filter_by(user_id=user.id, command=cmd_str).first()
-    if cmd is None:
-        return None
-    return cmd
+    The helper commits its own work, so the connection is back in the pool before the handler
+    talks to Telegram or Google and a reply is only sent for committed changes. Whatever is left
+    uncommitted when the block exits is rolled back.
+    """
+    async with new_session() as session:
+        yield session
 
 
-def add_user_command(telegram_id: int, cmd: CommandSearch):
-    cmd.command = cmd.command.lower()
-    if len(cmd.command) == 0:
-        raise errors.WrongCommandFormat()
-    elif cmd.command[0] != "/":
-        raise errors.WrongCommandFormat()
-    session = Session()
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if user is None:
-        raise errors.UserNotFound()
-    if session.query(CommandSearch).filter_by(user_id=user.id, command=cmd.command).count():
-        raise errors.CommandIsAlreadyExist()
-    cmd.user_id = user.id
-    session.add(cmd)
-    session.commit()
-    session.close()
+# ActiveUser per telegram_id, `_UNKNOWN_USER` marks users that are not registered.
+auth_cache = TTLCache(ttl=settings.AUTH_CACHE_TTL, max_entries=settings.AUTH_CACHE_MAX_ENTRIES)
+_UNKNOWN_USER = object()
 
 
-def remove_user_command(telegram_id: int, cmd_str: str):
-    session = Session()
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if user is None:
-        raise errors.UserNotFound()
-    cmd = session.query(CommandSearch).filter_by(user_id=user.id, command=cmd_str).first()
-    if cmd is None:
-        raise errors.CmdNotFound()
-    session.delete(cmd)
-    session.commit()
-    session.close()
+# Saved commands of a user as {command: SavedCommand}, keyed by telegram_id.
+command_index = TTLCache(ttl=settings.COMMAND_INDEX_TTL, max_entries=settings.COMMAND_INDEX_MAX_USERS)
 
 
-def my_search_commands(telegram_id: int) -> list:
-    session = Session()
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if user is None:
-        raise errors.UserNotFound()
-    cmd = session.query(CommandSearch).filter_by(user_id=user.id).all()
-    if cmd is None:
-        raise errors.CmdNotFound()
-    return cmd
+user_count_cache = TTLCache(ttl=settings.USER_COUNT_TTL, max_entries=1)
+
+
+def invalidate_user(telegram_id: int):
+    auth_cache.pop(telegram_id)
+
 
+def forget_user(telegram_id: int):
+    auth_cache.pop(telegram_id)
+    command_index.pop(telegram_id)
 
-def active_user(telegram_id, verify_code):
-    session = Session()
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+
+def _invalidate_everywhere(session: AsyncSession, telegram_id: int):
+    # Committed with the change, the other bot processes drop their copies when they see it.
+    if settings.CACHE_SYNC_INTERVAL > 0:
+        session.add(CacheInvalidation(telegram_id=telegram_id, created_at=int(time.time())))
+
+
+async def _get_user(session: AsyncSession, telegram_id: int) -> User:
+    user = await session.scalar(select(User).filter_by(telegram_id=telegram_id).limit(1))
     if user is None:
         raise errors.UserNotFound()
-    if user.verify_code != verify_code:
-        raise errors.VerifyCodeWrong()
-    user.verified = True
-    session.flush()
-    session.commit()
-    session.close()
+    return user
 
 
-def get_active_user(telegram_id) -> Type[User]:
-    session = Session()
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+@observe_db
+async def save_user(telegram_id, fullname, username, verify_code, admin_text: str | None = None):
+    """
+    `admin_text` is queued for the admin in the same transaction, see outbox.py.
+    """
+    async with _session() as session:
+        user = User(telegram_id=telegram_id, fullname=fullname, verify_code=verify_code, username=username)
+        session.add(user)
+        if admin_text is not None:
+            now = int(time.time())
+            session.add(AdminOutbox(text=admin_text, created_at=now, attempts=0, next_attempt_at=now))
+        _invalidate_everywhere(session, telegram_id)
+        await session.commit()
+    invalidate_user(telegram_id)
+
+
+def user_commands_query(telegram_id: int) -> Select:
+    # One row per command, or a single row with command None when the user has none.
+    return (
+        select(User.id, CommandSearch.command, CommandSearch.keyword, CommandSearch.desc,
+               CommandSearch.schedule_minutes)
+        .outerjoin(CommandSearch, CommandSearch.user_id == User.id)
+        .where(User.telegram_id == telegram_id)
+    )
+
+
+def user_command_query(telegram_id: int, cmd_str: str) -> Select:
+    # Commands are saved lowercased by add_user_command.
+    return (
+        select(User.id, CommandSearch)
+        .outerjoin(CommandSearch, and_(CommandSearch.user_id == User.id, CommandSearch.command == cmd_str.lower()))
+        .where(User.telegram_id == telegram_id)
+    )
+
+
+async def _user_commands(telegram_id: int) -> dict:
+    commands = command_index.get(telegram_id)
+    if commands is None:
+        async with _session() as session:
+            rows = (await session.execute(user_commands_query(telegram_id))).all()
+        if not rows:
+            raise errors.UserNotFound()
+        commands = {
+            row.command.lower(): SavedCommand(row.command, row.keyword, row.desc, row.schedule_minutes)
+            for row in rows if row.command is not None
+        }
+        command_index.set(telegram_id, commands)
+    return commands
+
+
+def _index_command(telegram_id: int, cmd: CommandSearch):
+    commands = command_index.get(telegram_id)
+    if commands is not None:
+        commands[cmd.command.lower()] = SavedCommand.of(cmd)
+
+
+def _unindex_command(telegram_id: int, cmd_str: str):
+    commands = command_index.get(telegram_id)
+    if commands is not None:
+        commands.pop(cmd_str.lower(), None)
+
+
+@observe_db
+async def warm_command_index():
+    """
+    Load the saved commands of every user into `command_index` with one query.
+    """
+    if not settings.COMMAND_INDEX_WARMUP:
+        return
+    async with _session() as session:
+        rows = await session.execute(
+            select(User.telegram_id, CommandSearch.command, CommandSearch.keyword, CommandSearch.desc,
+                   CommandSearch.schedule_minutes)
+            .outerjoin(CommandSearch, CommandSearch.user_id == User.id)
+            .order_by(User.id)
+        )
+        index = {}
+        for telegram_id, command, keyword, desc, schedule_minutes in rows:
+            commands = index.setdefault(telegram_id, {})
+            if command is not None:
+                commands[command.lower()] = SavedCommand(command, keyword, desc, schedule_minutes)
+    for telegram_id, commands in index.items():
+        command_index.set(telegram_id, commands)
+
+
+@observe_db
+async def is_user_command_exist(telegram_id: int, cmd_str: str) -> bool:
+    commands = await _user_commands(telegram_id)
+    return cmd_str.lower() in commands
+
+
+@observe_db
+async def get_user_command(telegram_id: int, cmd_str: str) -> SavedCommand | None:
+    commands = await _user_commands(telegram_id)
+    return commands.get(cmd_str.lower())
+
+
+@observe_db
+async def add_user_command(telegram_id: int, cmd: CommandSearch):
+    cmd.command = cmd.command.lower()
+    if len(cmd.command) == 0:
+        raise errors.WrongCommandFormat()
+    elif cmd.command[0] != "/":
+        raise errors.WrongCommandFormat()
+    async with _session() as session:
+        command_exists = (
+            select(CommandSearch.id)
+            .where(CommandSearch.user_id == User.id, CommandSearch.command == cmd.command)
+            .exists()
+        )
+        row = (await session.execute(
+            select(User.id, command_exists).where(User.telegram_id == telegram_id)
+        )).first()
+        if row is None:
+            raise errors.UserNotFound()
+        user_id, exists = row
+        if exists:
+            raise errors.CommandIsAlreadyExist()
+        cmd.user_id = user_id
+        if cmd.schedule_minutes:
+            # The first run only records the links that already exist.
+            cmd.next_run_at = int(time.time())
+        session.add(cmd)
+        _invalidate_everywhere(session, telegram_id)
+        await session.commit()
+    _index_command(telegram_id, cmd)
+
+
+@observe_db
+async def remove_user_command(telegram_id: int, cmd_str: str):
+    async with _session() as session:
+        row = (await session.execute(user_command_query(telegram_id, cmd_str))).first()
+        if row is None:
+            raise errors.UserNotFound()
+        cmd = row[1]
+        if cmd is None:
+            raise errors.CmdNotFound()
+        await session.delete(cmd)
+        _invalidate_everywhere(session, telegram_id)
+        await session.commit()
+    _unindex_command(telegram_id, cmd_str)
+
+
+@observe_db
+async def my_search_commands(telegram_id: int) -> list[SavedCommand]:
+    commands = await _user_commands(telegram_id)
+    return list(commands.values())
+
+
+@observe_db
+async def active_user(telegram_id, verify_code):
+    async with _session() as session:
+        user = await _get_user(session, telegram_id)
+        if user.verify_code != verify_code:
+            raise errors.VerifyCodeWrong()
+        user.verified = True
+        _invalidate_everywhere(session, telegram_id)
+        await session.commit()
+    invalidate_user(telegram_id)
+
+
+@dataclass(frozen=True)
+class ActiveUser:
+    """
+    What auth_cache keeps of a user. Not an ORM instance: a rollback of the session that loaded
+    one would expire it in the cache.
+    """
+    id: int
+    telegram_id: int
+    verified: bool
+
+
+@observe_db
+async def get_active_user(telegram_id) -> ActiveUser:
+    user = auth_cache.get(telegram_id)
     if user is None:
+        async with _session() as session:
+            row = (await session.execute(
+                select(User.id, User.telegram_id, User.verified).filter_by(telegram_id=telegram_id).limit(1)
+            )).first()
+        if row is None:
+            user = _UNKNOWN_USER
+            auth_cache.set(telegram_id, user, ttl=settings.AUTH_CACHE_NEGATIVE_TTL)
+        else:
+            user = ActiveUser(row.id, row.telegram_id, row.verified is True)
+            auth_cache.set(telegram_id, user)
+    if user is _UNKNOWN_USER:
         raise errors.UserNotFound()
-    if user.verified is not True:
+    if not user.verified:
         raise errors.UserNotActive()
-    session.flush()
-    session.commit()
-    session.close()
     return user
 
 
-def get_all_users():
-    session = Session()
-    users = session.query(User).all()
-    session.close()
-    return [f"@{user.username}({user.telegram_id})" for user in users]
-
-
-def update_user(telegram_id, fullname, username):
-    session = Session()
-    user = get_active_user(telegram_id)
-    user.fullname = fullname
-    user.username = username
-    session.flush()
-    session.commit()
-    session.close()
+@dataclass
+class UsersPage:
+    users: list[str]
+    first_id: int | None
+    last_id: int | None
+    has_prev: bool
+    has_next: bool
+
+
+@observe_db
+async def get_users_page(cursor: int | None = None, backward: bool = False,
+                         limit: int = settings.USER_PAGE_SIZE) -> UsersPage:
+    """
+    Keyset pagination over users ordered by id.
+
+    Forward pages start after `cursor`, backward pages end before it.
+    One extra row is fetched to know whether there is another page in that direction.
+    """
+    stmt = select(User.id, User.username, User.telegram_id).limit(limit + 1)
+    if backward:
+        stmt = stmt.where(User.id < cursor).order_by(User.id.desc())
+    else:
+        if cursor is not None:
+            stmt = stmt.where(User.id > cursor)
+        stmt = stmt.order_by(User.id)
+    async with _session() as session:
+        rows = (await session.execute(stmt)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return UsersPage(
+        users=[f"@{username}({telegram_id})" for _, username, telegram_id in rows],
+        first_id=rows[0][0] if rows else None,
+        last_id=rows[-1][0] if rows else None,
+        has_prev=has_more if backward else cursor is not None,
+        has_next=True if backward else has_more,
+    )
+
+
+@observe_db
+async def approximate_user_count() -> int:
+    count = user_count_cache.get("user")
+    if count is None:
+        async with _session() as session:
+            if get_engine().dialect.name == "mysql":
+                # InnoDB keeps an estimate of the row count, no table scan needed.
+                count = await session.scalar(text(
+                    "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'user'"
+                ))
+            else:
+                count = await session.scalar(select(func.count()).select_from(User))
+        count = count or 0
+        user_count_cache.set("user", count)
+    return count
+
+
+@observe_db
+async def update_user(telegram_id, fullname, username):
+    async with _session() as session:
+        user = await _get_user(session, telegram_id)
+        if user.verified is not True:
+            raise errors.UserNotActive()
+        user.fullname = fullname
+        user.username = username
+        _invalidate_everywhere(session, telegram_id)
+        await session.commit()
+    invalidate_user(telegram_id)
+
+
+@observe_db
+async def due_scheduled_commands(now: int, limit: int) -> list[tuple[int, CommandSearch]]:
+    """
+    Scheduled commands of verified users whose next run is due, as (telegram_id, command).
+    """
+    async with _session() as session:
+        rows = await session.execute(
+            select(User.telegram_id, CommandSearch)
+            .join(User, CommandSearch.user_id == User.id)
+            .where(
+                CommandSearch.schedule_minutes.is_not(None),
+                CommandSearch.next_run_at <= now,
+                User.verified.is_(True),
+            )
+            .order_by(CommandSearch.next_run_at)
+            .limit(limit)
+        )
+        return [(telegram_id, cmd) for telegram_id, cmd in rows]
+
+
+@observe_db
+async def claim_scheduled_command(cmd_id: int, next_run_at: int, new_next_run_at: int) -> bool:
+    """
+    Move the next run of a command forward. Only one bot process wins the claim for a run.
+    """
+    async with _session() as session:
+        result = await session.execute(
+            update(CommandSearch)
+            .where(CommandSearch.id == cmd_id, CommandSearch.next_run_at == next_run_at)
+            .values(next_run_at=new_next_run_at)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    return result.rowcount == 1
+
+
+@observe_db
+async def save_seen_links(cmd_id: int, seen_links: bytes):
+    async with _session() as session:
+        await session.execute(
+            update(CommandSearch)
+            .where(CommandSearch.id == cmd_id)
+            .values(seen_links=seen_links)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+
+@observe_db
+async def claim_admin_notices(now: int, lease: int, limit: int) -> list[AdminOutbox]:
+    """
+    Take up to `limit` due notices for `lease` seconds, so no other bot process delivers them meanwhile.
+    """
+    token = secrets.token_hex(16)
+    async with _session() as session:
+        due = (
+            select(AdminOutbox.id)
+            .where(AdminOutbox.next_attempt_at <= now)
+            .order_by(AdminOutbox.id)
+            .limit(limit)
+        )
+        ids = list((await session.scalars(due)).all())
+        if not ids:
+            return []
+        await session.execute(
+            update(AdminOutbox)
+            .where(AdminOutbox.id.in_(ids), AdminOutbox.next_attempt_at <= now)
+            .values(claimed_by=token, next_attempt_at=now + lease)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+        notices = await session.scalars(
+            select(AdminOutbox).where(AdminOutbox.claimed_by == token).order_by(AdminOutbox.id)
+        )
+        return list(notices.all())
+
+
+@observe_db
+async def delete_admin_notices(ids: list[int]):
+    async with _session() as session:
+        await session.execute(delete(AdminOutbox).where(AdminOutbox.id.in_(ids)))
+        await session.commit()
+
+
+@observe_db
+async def retry_admin_notices(ids: list[int], attempts: int, next_attempt_at: int):
+    async with _session() as session:
+        await session.execute(
+            update(AdminOutbox)
+            .where(AdminOutbox.id.in_(ids))
+            .values(attempts=attempts, next_attempt_at=next_attempt_at, claimed_by=None)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+
+# Row of SearchQuota counting the calls of the whole bot.
+_BOT_QUOTA = 0
+
+
+def _ensure_quota_row(dialect: str, day: str, owner: int):
+    """
+    Insert the (day, owner) row of search_quota unless it exists, and lock it for the transaction.
+    """
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        # Not INSERT IGNORE: its shared lock on an existing row, upgraded by the UPDATE that
+        # follows, deadlocks two workers charging the same row. This takes the exclusive lock.
+        stmt = insert(SearchQuota).values(day=day, user_id=owner, used=0)
+        return stmt.on_duplicate_key_update(used=SearchQuota.used)
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert(SearchQuota).values(day=day, user_id=owner, used=0).on_conflict_do_nothing()
+
+
+@observe_db
+async def charge_search_quota(day: str, user_id: int | None, calls: int, daily_limit: int, user_daily_limit: int):
+    """
+    Add `calls` to the API calls of `day` of the whole bot and of `user_id`, in one transaction.
+
+    Raises errors.QuotaExceeded or errors.UserQuotaExceeded, and charges nothing, when that would
+    go over a limit. Each row is created before it is updated, so no UPDATE of a missing row takes
+    a gap lock, and the bot row always comes first, so concurrent charges lock in the same order.
+    """
+    budgets = [(_BOT_QUOTA, daily_limit, errors.QuotaExceeded)]
+    if user_id is not None:
+        budgets.append((user_id, user_daily_limit, errors.UserQuotaExceeded))
+    dialect = get_engine().dialect.name
+    async with _session() as session:
+        for owner, limit, error in budgets:
+            await session.execute(_ensure_quota_row(dialect, day, owner))
+            charged = await session.execute(
+                update(SearchQuota)
+                .where(SearchQuota.day == day, SearchQuota.user_id == owner, SearchQuota.used + calls <= limit)
+                .values(used=SearchQuota.used + calls)
+                .execution_options(synchronize_session=False)
+            )
+            if charged.rowcount != 1:
+                raise error()
+        await session.commit()
+
+
+@observe_db
+async def search_quota_used(day: str, user_id: int | None = None) -> int:
+    owner = _BOT_QUOTA if user_id is None else user_id
+    async with _session() as session:
+        used = await session.scalar(
+            select(SearchQuota.used).where(SearchQuota.day == day, SearchQuota.user_id == owner)
+        )
+    return used or 0
+
+
+@observe_db
+async def purge_search_quota(before_day: str):
+    async with _session() as session:
+        await session.execute(delete(SearchQuota).where(SearchQuota.day < before_day))
+        await session.commit()
+
+
+@observe_db
+async def cache_invalidations_since(since: int) -> set[int]:
+    """
+    telegram_id of the users changed at or after `since`.
+    """
+    async with _session() as session:
+        rows = await session.scalars(
+            select(CacheInvalidation.telegram_id).where(CacheInvalidation.created_at >= since).distinct()
+        )
+        return set(rows)
+
+
+@observe_db
+async def purge_cache_invalidations(before: int):
+    async with _session() as session:
+        await session.execute(delete(CacheInvalidation).where(CacheInvalidation.created_at < before))
+        await session.commit()
+
+
+@observe_db
+async def save_search_result(rid: str, owner_id: int, data: bytes, expires_at: int):
+    async with _session() as session:
+        session.add(SearchResult(rid=rid, owner_id=owner_id, data=data, expires_at=expires_at))
+        await session.commit()
+
+
+@observe_db
+async def load_search_result(rid: str) -> tuple[int, bytes] | None:
+    """
+    (owner_id, data) of a search result that has not expired.
+    """
+    async with _session() as session:
+        row = (await session.execute(
+            select(SearchResult.owner_id, SearchResult.data)
+            .where(SearchResult.rid == rid, SearchResult.expires_at > int(time.time()))
+        )).first()
+    return None if row is None else (row.owner_id, row.data)
+
+
+@observe_db
+async def purge_search_results():
+    async with _session() as session:
+        await session.execute(delete(SearchResult).where(SearchResult.expires_at <= int(time.time())))
+        await session.commit()
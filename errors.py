@@ -31,3 +31,31 @@ class UserNotActive(Exception):
 class VerifyCodeWrong(Exception):
     def __str__(self):
         return "Verify Code is wrong!"
+
+
+class QuotaExceeded(Exception):
+    def __str__(self):
+        return "Search quota is exhausted"
+
+
+class UserQuotaExceeded(QuotaExceeded):
+    def __str__(self):
+        return "User search quota is exhausted"
+
+
+class SearchRateLimited(QuotaExceeded):
+    def __str__(self):
+        return "Too many searches right now"
+
+
+class SearchUnavailable(Exception):
+    def __str__(self):
+        return "Google search is unavailable"
+
+
+class SearchRejected(Exception):
+    def __init__(self, status: int):
+        self.status = status
+
+    def __str__(self):
+        return f"Google rejected the search with HTTP {self.status}"
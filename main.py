@@ -1,7 +1,6 @@
 import logging, sys
 import asyncio
 
-import requests
 from aiogram import Bot, Dispatcher, types
 from aiogram.enums import ParseMode
 
@@ -9,38 +8,14 @@ from aiogram.filters import CommandStart, Command
 from aiogram.types import Message
 from aiogram.utils.markdown import hbold
 
+import callbacks
 import settings
+from search import start_http_client, close_http_client
 
 dp = Dispatcher()
-
-mobile_agent = 'Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1'
-desktop_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.85 Safari/537.36'
-
-
-async def search_google(query, user_agent):
-    base_url = "https://www.googleapis.com/customsearch/v1"
-
-    params = {
-        "key": settings.GOOGLE_API,
-        "cx": settings.GOOGLE_CX,
-        "q": query,
-        "gl": "id",
-        "userAgent": user_agent,
-        "lr": "lang_id",
-        # "cr": "countryID",
-    }
-
-    try:
-        response = requests.get(base_url, params=params)
-        data = response.json()
-        items = data.get("items", [])
-
-        titles = [item.get("title", "") + " \nlink :" + item.get("link", "") for item in items]
-        return titles
-    except Exception as e:
-        print(f"Terjadi kesalahan: {e}")
-        return None
-
+dp.include_router(callbacks.create_router())
+dp.startup.register(start_http_client)
+dp.shutdown.register(close_http_client)
 
 #
 # @dp.message_handler(commands=['start', 'help'])
@@ -76,11 +51,6 @@ async def command_start_handler(message: Message) -> None:
     await message.answer(f"Hello, {hbold(message.from_user.full_name)}!") @ dp.message(CommandStart())
 
 
-@dp.callback_query()
-async def callback_data(query: types.CallbackQuery):
-    print(f"ada callback : {query.message}")
-
-
 @dp.message(Command(commands=["search"]))
 async def command_handler(message: Message) -> None:
     await message.answer(f"Search yahh: {message.text} :::, {hbold(message.from_user.full_name)}!")
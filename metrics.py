@@ -0,0 +1,96 @@
+"""
+Prometheus metrics.
+
+Served at /metrics by the webhook app, and in polling mode by a small HTTP server on METRICS_PORT.
+With several webhook workers set PROMETHEUS_MULTIPROC_DIR, so every worker answers with the
+metrics of all of them.
+"""
+import functools
+import logging
+import os
+import time
+
+from aiohttp import web
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+SEARCH_LATENCY = Histogram(
+    "search_google_seconds", "Time to get one page of search results", ["profile", "cache"],
+    buckets=(0.005, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8),
+)
+DB_LATENCY = Histogram(
+    "db_helper_seconds", "Duration of the database.py helpers", ["function"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+HANDLER_LATENCY = Histogram(
+    "handler_seconds", "Duration of update handlers", ["scene", "handler"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16),
+)
+UPDATES_IN_FLIGHT = Gauge("updates_in_flight", "Updates being handled right now", multiprocess_mode="livesum")
+SEND_QUEUE = Gauge(
+    "send_queue_depth", "Telegram requests waiting in the send throttle", multiprocess_mode="livesum"
+)
+SEND_THROTTLED = Counter("send_throttled_total", "Telegram requests that had to wait in the send throttle")
+SEND_RETRIES = Counter("send_flood_retries_total", "Telegram requests sent again after RetryAfter")
+ERRORS = Counter("bot_errors_total", "Errors by exception class and where they were raised", ["error", "where"])
+
+
+def count_error(error: BaseException, where: str):
+    ERRORS.labels(type(error).__name__, where).inc()
+
+
+def observe_db(fn):
+    """
+    Time a database helper and count the exceptions it raises, errors.UserNotFound and the like.
+    """
+    histogram = DB_LATENCY.labels(fn.__name__)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            count_error(e, "db")
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    response = web.Response(body=generate_latest(registry))
+    response.content_type = CONTENT_TYPE_LATEST.split(";")[0]
+    return response
+
+
+_runner: web.AppRunner | None = None
+
+
+async def start_metrics_server():
+    global _runner
+    if not settings.METRICS_PORT or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, settings.METRICS_HOST, settings.METRICS_PORT).start()
+    logger.info("serving metrics on %s:%s", settings.METRICS_HOST, settings.METRICS_PORT)
+
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+    _runner = None
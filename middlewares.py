@@ -0,0 +1,113 @@
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.scene import SceneHandlerWrapper
+from aiogram.types import TelegramObject
+
+from database import QueryStats, current_query_stats
+from metrics import HANDLER_LATENCY, UPDATES_IN_FLIGHT, count_error
+from profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+
+class DbStatsMiddleware(BaseMiddleware):
+    """
+    Counts the queries of an update and the time they took, injected into handlers as `db_stats`.
+
+    The helpers in database.py each run on a short-lived session and commit their own work
+    (database._session), so an update only holds a connection while it runs queries, never while
+    it waits on Google or Telegram, and a reply is only sent for committed changes.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        stats = QueryStats()
+        started = time.perf_counter()
+        token = current_query_stats.set(stats)
+        data["db_stats"] = stats
+        try:
+            return await handler(event, data)
+        finally:
+            current_query_stats.reset(token)
+            logger.debug(
+                "update handled in %.1f ms, %d queries, %.1f ms in database",
+                (time.perf_counter() - started) * 1000, stats.queries, stats.seconds * 1000,
+            )
+
+
+def _handler_labels(data: Dict[str, Any]) -> tuple[str, str]:
+    handler = data.get("handler")
+    if handler is None:
+        return "-", "-"
+    callback = handler.callback
+    if isinstance(callback, SceneHandlerWrapper):
+        return callback.scene.__name__, callback.handler.callback.__name__
+    return "-", getattr(callback, "__name__", type(callback).__name__)
+
+
+class UpdatesInFlightMiddleware(BaseMiddleware):
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        with UPDATES_IN_FLIGHT.track_inprogress():
+            return await handler(event, data)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner middleware, times the handler that was picked for the event.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        scene, name = _handler_labels(data)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            count_error(e, "handler")
+            raise
+        finally:
+            HANDLER_LATENCY.labels(scene, name).observe(time.perf_counter() - started)
+
+
+class ProfilerMiddleware(BaseMiddleware):
+    """
+    Inner middleware, hands the handler run to profiling.profiler while the admin has it on.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        if not profiler.enabled:
+            return await handler(event, data)
+        profile = profiler.start_cprofile()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            finished = time.perf_counter()
+            if profile is not None:
+                profiler.stop_cprofile(profile)
+            _, name = _handler_labels(data)
+            try:
+                await profiler.save(started, finished, data.get("raw_state"), name, profile)
+            except Exception:
+                logger.exception("could not save the profile of an update")
@@ -0,0 +1,165 @@
+"""
+Versioned schema migrations.
+
+Every migration runs once, in order, and its version is recorded in the `schema_version` table.
+Migrations are written to be idempotent, because databases created by older releases
+already have some of the objects they create.
+"""
+import logging
+from typing import Callable
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, delete, func, inspect, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn
+
+from database import (
+    AdminOutbox, Base, CacheInvalidation, CommandSearch, FsmState, SearchQuota, SearchResult, User, get_engine
+)
+
+logger = logging.getLogger(__name__)
+
+schema_metadata = MetaData()
+schema_version = Table(
+    "schema_version",
+    schema_metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(255)),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = []
+
+
+def migration(version: int, description: str):
+    def register(fn: Callable[[Connection], None]):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+
+    return register
+
+
+def _index_names(conn: Connection, table: str) -> set[str]:
+    inspector = inspect(conn)
+    names = {index["name"] for index in inspector.get_indexes(table)}
+    names |= {constraint["name"] for constraint in inspector.get_unique_constraints(table)}
+    return names
+
+
+def _has_unique_index_on(conn: Connection, table: str, columns: list[str]) -> bool:
+    inspector = inspect(conn)
+    for index in inspector.get_indexes(table):
+        if index.get("unique") and index["column_names"] == columns:
+            return True
+    for constraint in inspector.get_unique_constraints(table):
+        if constraint["column_names"] == columns:
+            return True
+    return False
+
+
+def _add_missing_columns(conn: Connection, table: Table):
+    existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+    preparer = conn.dialect.identifier_preparer
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        ddl = CreateColumn(column).compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}"))
+
+
+@migration(1, "initial schema")
+def _initial_schema(conn: Connection):
+    Base.metadata.create_all(conn)
+
+
+@migration(2, "unique (user_id, command) on command_search, unique telegram_id on user")
+def _command_search_unique_command(conn: Connection):
+    if not _has_unique_index_on(conn, "user", ["telegram_id"]):
+        Index("ix_user_telegram_id", User.telegram_id, unique=True).create(conn)
+
+    if "uq_command_search_user_command" in _index_names(conn, "command_search"):
+        return
+    # Older releases allowed the same command twice for one user, keep the oldest one.
+    duplicates = conn.execute(
+        select(CommandSearch.user_id, CommandSearch.command, func.min(CommandSearch.id))
+        .group_by(CommandSearch.user_id, CommandSearch.command)
+        .having(func.count() > 1)
+    ).all()
+    for user_id, command, keep_id in duplicates:
+        conn.execute(
+            delete(CommandSearch.__table__).where(
+                CommandSearch.user_id == user_id,
+                CommandSearch.command == command,
+                CommandSearch.id != keep_id,
+            )
+        )
+    Index(
+        "uq_command_search_user_command", CommandSearch.user_id, CommandSearch.command, unique=True
+    ).create(conn)
+
+
+@migration(3, "fsm_state table for the shared FSM storage")
+def _fsm_state(conn: Connection):
+    FsmState.__table__.create(conn, checkfirst=True)
+
+
+@migration(4, "schedule columns on command_search")
+def _command_search_schedule(conn: Connection):
+    table = CommandSearch.__table__
+    _add_missing_columns(conn, table)
+    if "ix_command_search_next_run_at" not in _index_names(conn, "command_search"):
+        Index("ix_command_search_next_run_at", table.c.next_run_at).create(conn)
+
+
+@migration(5, "admin_outbox table for admin notifications")
+def _admin_outbox(conn: Connection):
+    AdminOutbox.__table__.create(conn, checkfirst=True)
+
+
+@migration(6, "search_quota and cache_invalidation tables shared by bot processes")
+def _shared_state(conn: Connection):
+    SearchQuota.__table__.create(conn, checkfirst=True)
+    CacheInvalidation.__table__.create(conn, checkfirst=True)
+
+
+@migration(7, "search_result table for paging through results")
+def _search_result(conn: Connection):
+    SearchResult.__table__.create(conn, checkfirst=True)
+
+
+def _run_migrations(conn: Connection):
+    schema_metadata.create_all(conn)
+    applied = set(conn.execute(select(schema_version.c.version)).scalars())
+    for version, description, fn in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in applied:
+            continue
+        logger.info("applying schema migration %s: %s", version, description)
+        fn(conn)
+        conn.execute(schema_version.insert().values(version=version, description=description))
+
+
+async def migrate():
+    async with get_engine().begin() as conn:
+        is_mysql = conn.dialect.name == "mysql"
+        if is_mysql:
+            # Only one bot process may migrate at a time.
+            await conn.execute(text("SELECT GET_LOCK('schema_migrations', 60)"))
+        try:
+            await conn.run_sync(_run_migrations)
+        finally:
+            if is_mysql:
+                await conn.execute(text("SELECT RELEASE_LOCK('schema_migrations')"))
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    from database import close_db
+
+    async def main():
+        try:
+            await migrate()
+        finally:
+            await close_db()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+"""
+Delivery of admin notifications.
+
+Handlers never message the admin themselves: the notification is written to the `admin_outbox`
+table in the same transaction as the change it is about (see database.save_user), and
+`OutboxWorker` delivers it in the background. Notices that are due together are sent as one digest,
+and a failed delivery is retried with exponential backoff, so a slow or failing admin chat never
+holds up the user who triggered it.
+"""
+import asyncio
+import logging
+import random
+import time
+
+from aiogram import Bot
+
+import settings
+from database import AdminOutbox, claim_admin_notices, delete_admin_notices, retry_admin_notices
+from throttling import background_sends
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects longer messages.
+MAX_MESSAGE_LENGTH = 4096
+
+
+def digests(notices: list[AdminOutbox]) -> list[tuple[str, list[AdminOutbox]]]:
+    """
+    Group notices into as few messages as fit, as (text, notices) pairs.
+    """
+    groups: list[list[AdminOutbox]] = []
+    length = 0
+    for notice in notices:
+        if groups and length + len(notice.text) + 2 <= MAX_MESSAGE_LENGTH - 64:
+            groups[-1].append(notice)
+            length += len(notice.text) + 2
+        else:
+            groups.append([notice])
+            length = len(notice.text)
+    result = []
+    for group in groups:
+        text = "\n\n".join(notice.text for notice in group)
+        if len(group) > 1:
+            text = f"{len(group)} pendaftar baru:\n\n{text}"
+        result.append((text[:MAX_MESSAGE_LENGTH], group))
+    return result
+
+
+def retry_delay(attempts: int) -> int:
+    delay = min(settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), settings.OUTBOX_MAX_RETRY_DELAY)
+    return int(delay * random.uniform(1, 1.25))
+
+
+class OutboxWorker:
+    def __init__(self, bot: Bot, interval: float = settings.OUTBOX_INTERVAL,
+                 batch_size: int = settings.OUTBOX_BATCH_SIZE):
+        self.bot = bot
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop(), name="admin-outbox")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.deliver()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("admin outbox delivery failed")
+            # Sign-ups arriving in the meantime are sent together as one digest.
+            await asyncio.sleep(self.interval)
+
+    async def deliver(self) -> int:
+        """
+        Send the notices that are due, returns how many were delivered.
+        """
+        now = int(time.time())
+        notices = await claim_admin_notices(now, settings.OUTBOX_LEASE, self.batch_size)
+        delivered = 0
+        for text, group in digests(notices):
+            ids = [notice.id for notice in group]
+            try:
+                with background_sends():
+                    await self.bot.send_message(settings.ADMIN_USER_ID, text)
+            except Exception as e:
+                attempts = max(notice.attempts or 0 for notice in group) + 1
+                delay = retry_delay(attempts)
+                logger.warning("could not notify the admin about %d notices (attempt %d): %r, retrying in %ds",
+                               len(ids), attempts, e, delay)
+                await retry_admin_notices(ids, attempts, int(time.time()) + delay)
+                continue
+            await delete_admin_notices(ids)
+            delivered += len(ids)
+        return delivered
+
+
+outbox_worker: OutboxWorker | None = None
+
+
+def start_outbox(bot: Bot):
+    global outbox_worker
+    outbox_worker = OutboxWorker(bot)
+    outbox_worker.start()
+
+
+async def stop_outbox():
+    global outbox_worker
+    if outbox_worker is not None:
+        await outbox_worker.stop()
+        outbox_worker = None
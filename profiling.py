@@ -0,0 +1,189 @@
+"""
+Opt-in profiling of updates.
+
+While the profiler is on, a background thread samples the stack of the event loop thread every
+PROFILER_INTERVAL seconds. Every update slower than PROFILER_SLOW_THRESHOLD gets the samples taken
+while it ran written as collapsed stacks (one "frame;frame;frame count" line per stack, the input of
+flamegraph.pl and speedscope), and a PROFILER_SAMPLE_RATE fraction of updates is profiled with
+cProfile and written as pstats. The loop thread also runs other updates at the same time, so their
+frames can show up in a profile too; the handler frames tell them apart.
+
+Files go to PROFILER_DIR, named after the time, the scene state and the handler, and only the newest
+PROFILER_MAX_FILES are kept. The admin turns it on and off with /profiler on|off.
+"""
+import asyncio
+import cProfile
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from aiogram import F, Router
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _fold(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    Keeps the last `window` seconds of stack samples of one thread.
+    """
+
+    def __init__(self, interval: float, window: float):
+        self.interval = interval
+        self.samples: deque[tuple[float, str]] = deque(maxlen=max(1, int(window / interval)))
+        self._target: int | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.samples.clear()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self.samples.append((time.perf_counter(), _fold(frame)))
+            del frame
+
+    def collapsed(self, since: float, until: float) -> Counter:
+        return Counter(stack for taken_at, stack in list(self.samples) if since <= taken_at <= until)
+
+
+def _tag(value: str | None) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", value or "-")
+
+
+class Profiler:
+    def __init__(self, directory: str, sample_rate: float, slow_threshold: float,
+                 interval: float, max_files: int):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_files = max_files
+        # Long enough to cover any update that is worth a look.
+        self.sampler = StackSampler(interval, window=max(slow_threshold * 20, 60))
+        self.enabled = False
+        self._cprofile_busy = False
+
+    def enable(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.sampler.start()
+        self.enabled = True
+        logger.info("profiler on, writing to %s", self.directory)
+
+    def disable(self):
+        self.enabled = False
+        self.sampler.stop()
+        logger.info("profiler off")
+
+    def start_cprofile(self) -> cProfile.Profile | None:
+        """
+        Start a cProfile run for a sampled update, None when one is already running.
+        """
+        if self._cprofile_busy or random.random() >= self.sample_rate:
+            return None
+        self._cprofile_busy = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop_cprofile(self, profile: cProfile.Profile):
+        profile.disable()
+        self._cprofile_busy = False
+
+    def _path(self, kind: str, state: str | None, handler: str, seconds: float, suffix: str) -> str:
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-{seconds * 1000:.0f}ms-{_tag(state)}-{_tag(handler)}.{suffix}"
+        return os.path.join(self.directory, name)
+
+    def _rotate(self):
+        files = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in files[:max(len(files) - self.max_files, 0)]:
+            os.remove(entry.path)
+
+    def _write_collapsed(self, path: str, stacks: Counter):
+        with open(path, "w") as output:
+            for stack, count in stacks.most_common():
+                output.write(f"{stack} {count}\n")
+        self._rotate()
+
+    def _write_pstats(self, path: str, profile: cProfile.Profile):
+        profile.dump_stats(path)
+        self._rotate()
+
+    async def save(self, started: float, finished: float, state: str | None, handler: str,
+                   profile: cProfile.Profile | None):
+        seconds = finished - started
+        if profile is not None:
+            path = self._path("sampled", state, handler, seconds, "pstats")
+            await asyncio.to_thread(self._write_pstats, path, profile)
+        if seconds >= self.slow_threshold:
+            stacks = self.sampler.collapsed(started, finished)
+            if stacks:
+                path = self._path("slow", state, handler, seconds, "folded")
+                await asyncio.to_thread(self._write_collapsed, path, stacks)
+                logger.info("slow update (%.0f ms) in %s/%s profiled to %s", seconds * 1000, state, handler, path)
+
+
+profiler = Profiler(
+    directory=settings.PROFILER_DIR,
+    sample_rate=settings.PROFILER_SAMPLE_RATE,
+    slow_threshold=settings.PROFILER_SLOW_THRESHOLD,
+    interval=settings.PROFILER_INTERVAL,
+    max_files=settings.PROFILER_MAX_FILES,
+)
+
+
+async def toggle_profiler(message: Message, command: CommandObject):
+    action = (command.args or "").strip().lower()
+    if action == "on":
+        profiler.enable()
+    elif action == "off":
+        profiler.disable()
+    elif action:
+        await message.answer("gunakan /profiler on atau /profiler off")
+        return
+    status = "aktif" if profiler.enabled else "mati"
+    # Webhook workers are separate processes, each has its own profiler.
+    await message.answer(f"Profiler {status} di proses {os.getpid()}, file di {profiler.directory}")
+
+
+def create_router() -> Router:
+    # A new router per dispatcher, a router can only be attached once.
+    router = Router(name="profiler")
+    router.message.register(
+        toggle_profiler, Command("profiler"), F.from_user.id.func(lambda user_id: str(user_id) == settings.ADMIN_USER_ID)
+    )
+    return router
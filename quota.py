@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import errors
+import settings
+from database import charge_search_quota, purge_search_quota, search_quota_used
+
+logger = logging.getLogger(__name__)
+
+# The Custom Search JSON API quota resets at midnight Pacific Time.
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+
+class QuotaManager:
+    """
+    Budget for Google Custom Search API calls.
+
+    Every call is charged against a daily limit, a per-user daily share and a per-minute limit.
+    The daily counts live in the search_quota table, so every bot process spends from the same
+    budget and a restart does not reset it. Requests over the daily limits are rejected, requests
+    over the per-minute limit wait for a free slot for up to `max_wait` seconds. The per-minute window is
+    kept in the process, with several webhook workers `per_minute_limit` is the share of one worker.
+    """
+
+    def __init__(self, daily_limit: int, user_daily_limit: int, per_minute_limit: int, max_wait: float):
+        self.daily_limit = daily_limit
+        self.user_daily_limit = user_daily_limit
+        self.per_minute_limit = per_minute_limit
+        self.max_wait = max_wait
+        self.rejected_today = 0
+        self._minute_window: deque[float] = deque()
+        self._day = self._today()
+        self._purged_before: str | None = None
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+    def _roll_day(self) -> str:
+        today = self._today()
+        if today != self._day:
+            self._day = today
+            self.rejected_today = 0
+        return today
+
+    async def remaining_today(self, user_id: int | None = None) -> int:
+        day = self._roll_day()
+        remaining = self.daily_limit - await search_quota_used(day)
+        if user_id is not None:
+            remaining = min(remaining, self.user_daily_limit - await search_quota_used(day, user_id))
+        return max(remaining, 0)
+
+    async def acquire(self, user_id: int | None, calls: int = 1) -> None:
+        """
+        Charge `calls` API calls to `user_id` (None for calls made by the bot itself).
+        """
+        if calls <= 0:
+            return
+        if calls > self.per_minute_limit:
+            raise errors.SearchRateLimited()
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            # Nothing is awaited between the check and the reservation, so no lock is needed and
+            # no search waits behind another one's sleep or database write.
+            now = time.monotonic()
+            while self._minute_window and self._minute_window[0] <= now - 60:
+                self._minute_window.popleft()
+            overflow = len(self._minute_window) + calls - self.per_minute_limit
+            if overflow <= 0:
+                self._minute_window.extend([now] * calls)
+                break
+            wait = self._minute_window[overflow - 1] + 60 - now
+            if now + wait > deadline:
+                self.rejected_today += 1
+                raise errors.SearchRateLimited()
+            await asyncio.sleep(wait)
+        day = self._roll_day()
+        try:
+            await charge_search_quota(day, user_id, calls, self.daily_limit, self.user_daily_limit)
+        except BaseException as e:
+            # Nothing was charged, give the reserved slots back.
+            for _ in range(calls):
+                self._minute_window.remove(now)
+            if isinstance(e, errors.QuotaExceeded):
+                self.rejected_today += 1
+                if type(e) is errors.QuotaExceeded:
+                    logger.warning("Google search daily quota of %s calls is used up", self.daily_limit)
+            raise
+        if self._purged_before != day:
+            self._purged_before = day
+            await purge_search_quota(day)
+
+
+# Webhook workers are separate processes that share one API key.
+_workers = settings.WEBHOOK_WORKERS if settings.BOT_MODE == "webhook" else 1
+
+quota = QuotaManager(
+    daily_limit=settings.GOOGLE_DAILY_QUOTA,
+    user_daily_limit=settings.GOOGLE_USER_DAILY_QUOTA,
+    per_minute_limit=max(settings.GOOGLE_MINUTE_QUOTA // max(_workers, 1), 1),
+    max_wait=settings.GOOGLE_QUOTA_MAX_WAIT,
+)
@@ -0,0 +1,162 @@
+"""
+Timeouts, retries and a circuit breaker around the Google Custom Search API.
+
+Every API call gets GOOGLE_ATTEMPT_TIMEOUT seconds per attempt and GOOGLE_TOTAL_TIMEOUT seconds
+in all. Only answers that may succeed when asked again (HTTP 5xx and 429) are retried, up to
+GOOGLE_MAX_RETRIES times with exponential backoff and full jitter, so callers that failed together
+do not retry together. After GOOGLE_BREAKER_THRESHOLD failed calls in a row the breaker opens and
+calls fail right away for GOOGLE_BREAKER_RESET seconds; then one trial call is let through, and
+its outcome closes the breaker or opens it again.
+
+Only signs of an outage count as breaker failures: retryable answers, timeouts and connection
+errors. A failed call raises errors.SearchUnavailable, which search.py reports as "upstream failed"
+instead of "no results". A request the API refuses (any other 4xx) is not retried and counts as
+an answer, since asking again cannot change it. Only HTTP 400 is about the query and raises
+errors.SearchRejected. The others, e.g. 401 and 403 for a bad or exhausted API key, are a problem
+of the bot's setup: they are logged as errors and raise errors.SearchUnavailable.
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, TypeVar
+
+import aiohttp
+
+import errors
+import settings
+from metrics import count_error
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class RetryableError(Exception):
+    """
+    Raised by an attempt whose answer may be different when asked again, e.g. HTTP 503.
+    """
+
+
+def backoff_delay(retry: int, base: float, max_delay: float) -> float:
+    return random.uniform(0, min(base * 2 ** retry, max_delay))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allows_calls(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half-open" and not self._trial)
+
+    def before_call(self):
+        """
+        Raise errors.SearchUnavailable while the breaker is open, or while another call is the trial.
+        """
+        if not self.allows_calls():
+            raise errors.SearchUnavailable()
+        if self.state == "half-open":
+            self._trial = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Google API is back, closing the circuit breaker")
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("Google API failed %s times in a row, opening the circuit breaker", self.failures)
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+    def cancel_call(self):
+        # A cancelled trial says nothing about the API, let the next call try.
+        self._trial = False
+
+
+async def _attempts(attempt: Callable[[], Awaitable[T]], attempt_timeout: float, max_retries: int,
+                    retry_delay: float, max_retry_delay: float) -> T:
+    retry = 0
+    while True:
+        try:
+            return await asyncio.wait_for(attempt(), attempt_timeout)
+        except RetryableError as e:
+            if retry >= max_retries:
+                raise
+            delay = backoff_delay(retry, retry_delay, max_retry_delay)
+            logger.info("Google API answered %s, retrying in %.2fs", e, delay)
+            retry += 1
+            await asyncio.sleep(delay)
+
+
+async def call_with_retries(
+        attempt: Callable[[], Awaitable[T]],
+        breaker: CircuitBreaker,
+        attempt_timeout: float = settings.GOOGLE_ATTEMPT_TIMEOUT,
+        total_timeout: float = settings.GOOGLE_TOTAL_TIMEOUT,
+        max_retries: int = settings.GOOGLE_MAX_RETRIES,
+        retry_delay: float = settings.GOOGLE_RETRY_DELAY,
+        max_retry_delay: float = settings.GOOGLE_MAX_RETRY_DELAY,
+) -> T:
+    """
+    Run `attempt` until it succeeds, fails for good or runs out of time; raises errors.SearchUnavailable,
+    or errors.SearchRejected from `attempt` as is when the refusal is about the query.
+    """
+    try:
+        breaker.before_call()
+    except errors.SearchUnavailable as e:
+        count_error(e, "google")
+        raise
+    try:
+        result = await asyncio.wait_for(
+            _attempts(attempt, attempt_timeout, max_retries, retry_delay, max_retry_delay), total_timeout
+        )
+    except asyncio.CancelledError:
+        breaker.cancel_call()
+        raise
+    except errors.SearchRejected as e:
+        # The API is up and answered, the request itself is wrong.
+        breaker.record_success()
+        count_error(e, "google")
+        if e.status != 400:
+            logger.error("%s, check GOOGLE_API, GOOGLE_CX, GOOGLE_SEARCH_URL and the API quota", e)
+            raise errors.SearchUnavailable() from e
+        logger.warning("Google API call rejected: %s", e)
+        raise
+    except (RetryableError, asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+        breaker.record_failure()
+        count_error(e, "google")
+        logger.warning("Google API call failed: %s %s", type(e).__name__, e)
+        raise errors.SearchUnavailable() from e
+    except Exception as e:
+        # Not a sign of an outage, e.g. an unreadable answer; it does not count against the breaker.
+        breaker.cancel_call()
+        count_error(e, "google")
+        # aiohttp puts the request URL, API key included, into the message of these errors.
+        logger.warning("Google API call failed: %s", type(e).__name__)
+        raise errors.SearchUnavailable() from e
+    breaker.record_success()
+    return result
+
+
+google_breaker = CircuitBreaker(
+    failure_threshold=settings.GOOGLE_BREAKER_THRESHOLD,
+    reset_timeout=settings.GOOGLE_BREAKER_RESET,
+)
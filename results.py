@@ -0,0 +1,268 @@
+"""
+Search results kept on the server for paging.
+
+A search stores its results under a short random id and the bot shows one page of one profile at
+a time. The inline buttons carry only (id, profile, page), so turning pages or switching between
+the desktop and mobile results never calls Google again. Stored results go to the search_result
+table, so a button works whichever bot process the callback reaches, and expire after RESULT_TTL
+seconds. Each process keeps the results it stored or read in `result_store`, the oldest dropped
+first once RESULT_MAX_BYTES is reached.
+"""
+import asyncio
+import json
+import logging
+import secrets
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Sequence
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardMarkup, Message
+from aiogram.utils.formatting import Bold, Text, as_list, as_numbered_list, as_section
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+import settings
+from cache import TTLCache
+from database import load_search_result, purge_search_results, save_search_result
+from search import DEFAULT_PROFILES, ProfileResult, SearchItem, SearchProfile, empty_results_text, has_results
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StoredResult:
+    query: str
+    owner_id: int
+    results: list[ProfileResult]
+
+    def profile(self, name: str) -> ProfileResult | None:
+        for result in self.results:
+            if result.profile.name == name:
+                return result
+        return None
+
+
+class ResultPage(CallbackData, prefix="res"):
+    rid: str
+    profile: str
+    page: int
+
+
+def _stored_size(stored: StoredResult) -> int:
+    size = len(stored.query) + 128
+    for result in stored.results:
+        for item in result.items or ():
+            size += len(item.title) + len(item.link) + 64
+    return size
+
+
+result_store = TTLCache(
+    ttl=settings.RESULT_TTL,
+    max_entries=settings.RESULT_MAX_ENTRIES,
+    max_bytes=settings.RESULT_MAX_BYTES,
+    sizeof=_stored_size,
+)
+
+
+def _encode(stored: StoredResult) -> bytes:
+    payload = {"query": stored.query, "results": [asdict(result) for result in stored.results]}
+    return zlib.compress(json.dumps(payload, separators=(",", ":")).encode())
+
+
+def _decode(owner_id: int, data: bytes) -> StoredResult:
+    payload = json.loads(zlib.decompress(data))
+    results = []
+    for result in payload["results"]:
+        items = result.pop("items")
+        results.append(ProfileResult(
+            profile=SearchProfile(**result.pop("profile")),
+            items=None if items is None else [SearchItem(*item) for item in items],
+            **result,
+        ))
+    return StoredResult(payload["query"], owner_id, results)
+
+
+_last_purge = time.monotonic()
+
+
+async def store_results(stored: StoredResult) -> str:
+    global _last_purge
+    rid = secrets.token_urlsafe(6)
+    await save_search_result(rid, stored.owner_id, _encode(stored), int(time.time() + settings.RESULT_TTL))
+    result_store.set(rid, stored)
+    if time.monotonic() - _last_purge > settings.RESULT_PURGE_INTERVAL:
+        _last_purge = time.monotonic()
+        await purge_search_results()
+    return rid
+
+
+async def load_results(rid: str) -> StoredResult | None:
+    stored = result_store.get(rid)
+    if stored is None:
+        row = await load_search_result(rid)
+        if row is None:
+            return None
+        stored = _decode(*row)
+        result_store.set(rid, stored)
+    return stored
+
+
+def first_page(stored: StoredResult) -> str:
+    """
+    Name of the profile to show first, the first one that found something.
+    """
+    for result in stored.results:
+        if result.items:
+            return result.profile.name
+    return stored.results[0].profile.name
+
+
+def page_count(result: ProfileResult, page_size: int = settings.RESULT_PAGE_SIZE) -> int:
+    return max(1, -(-len(result.items or ()) // page_size))
+
+
+def _page_body(result: ProfileResult, start: int, page_size: int):
+    if result.timed_out:
+        return "Waktu pencarian habis"
+    if result.failed:
+        return "Pencarian Google gagal"
+    if result.rejected:
+        return "Pencarian ditolak oleh Google"
+    if not result.items:
+        return "Tidak ada hasil"
+    items = result.items[start:start + page_size]
+    return as_numbered_list(*[item.as_text() for item in items], start=start + 1)
+
+
+def result_page(rid: str, stored: StoredResult, profile: str, page: int,
+                page_size: int = settings.RESULT_PAGE_SIZE) -> tuple[Text, InlineKeyboardMarkup]:
+    result = stored.profile(profile) or stored.results[0]
+    pages = page_count(result, page_size)
+    page = min(max(page, 0), pages - 1)
+    start = page * page_size
+
+    header = f"{result.profile.name} Result: {stored.query} ({page + 1}/{pages})"
+    if result.pages_fetched:
+        header += f", {result.pages_fetched} halaman Google"
+    content = as_section(Bold(header + "\n"), _page_body(result, start, page_size))
+
+    builder = InlineKeyboardBuilder()
+    navigation = 0
+    if page > 0:
+        navigation += 1
+        builder.button(text="⬅️ Prev", callback_data=ResultPage(rid=rid, profile=result.profile.name, page=page - 1))
+    if page + 1 < pages:
+        navigation += 1
+        builder.button(text="Next ➡️", callback_data=ResultPage(rid=rid, profile=result.profile.name, page=page + 1))
+    switches = 0
+    for other in stored.results:
+        if other.profile.name != result.profile.name:
+            switches += 1
+            builder.button(
+                text=f"🔁 {other.profile.name}",
+                callback_data=ResultPage(rid=rid, profile=other.profile.name, page=0),
+            )
+    builder.adjust(*(size for size in (navigation, switches) if size))
+    return content, builder.as_markup()
+
+
+
+def progress_content(query: str, profiles: Sequence[SearchProfile], settled: dict[str, ProfileResult],
+                     page_size: int = settings.RESULT_PAGE_SIZE) -> Text:
+    """
+    First page of the first profile that found something, while the others are still searching.
+    """
+    shown = next((result for result in settled.values() if result.items), None)
+    waiting = [profile.name for profile in profiles if profile.name not in settled]
+    sections = []
+    if shown is not None:
+        sections.append(as_section(
+            Bold(f"{shown.profile.name} Result: {query}\n"), _page_body(shown, 0, page_size)
+        ))
+        sections.append("")
+    if waiting:
+        sections.append(f"Menunggu hasil {', '.join(waiting)} . . .")
+    return as_list(*sections)
+
+
+class ProgressiveReply:
+    """
+    Edits the "Mencari . . ." placeholder in place while the profiles of a search come in.
+
+    Progress edits are coalesced to at most one per `min_interval` seconds, each showing the latest
+    state, to stay under Telegram's edit limits. `finish` replaces it with the first page of the
+    results right away; the session throttle (throttling.py) still paces it within the chat limit.
+    """
+
+    def __init__(self, placeholder: Message, query: str, owner_id: int,
+                 profiles: Sequence[SearchProfile] = DEFAULT_PROFILES,
+                 min_interval: float = settings.EDIT_MIN_INTERVAL):
+        self.placeholder = placeholder
+        self.query = query
+        self.owner_id = owner_id
+        self.profiles = profiles
+        self.min_interval = min_interval
+        self.settled: dict[str, ProfileResult] = {}
+        self._last_edit = time.monotonic()
+        self._dirty = False
+        self._task: asyncio.Task | None = None
+
+    def update(self, result: ProfileResult):
+        self.settled[result.profile.name] = result
+        if len(self.settled) == len(self.profiles):
+            # The final edit is coming right away.
+            return
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._edit_later())
+
+    async def _wait_interval(self):
+        await asyncio.sleep(max(self._last_edit + self.min_interval - time.monotonic(), 0))
+
+    async def _edit_later(self):
+        while self._dirty:
+            await self._wait_interval()
+            self._dirty = False
+            try:
+                await self._edit(progress_content(self.query, self.profiles, self.settled))
+            except Exception as e:
+                # Progress is best effort, `finish` still shows the results.
+                logger.warning("could not show search progress: %r", e)
+
+    async def _edit(self, content: Text, markup: InlineKeyboardMarkup | None = None):
+        try:
+            await self.placeholder.edit_text(**content.as_kwargs(), reply_markup=markup)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logger.warning("could not edit search message: %s", e)
+        finally:
+            self._last_edit = time.monotonic()
+
+    async def _stop_edits(self):
+        if self._task is None:
+            return
+        # Awaited even when it is done, so whatever it raised is logged instead of lost.
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("search progress edits failed")
+        self._task = None
+
+    async def finish(self, results: list[ProfileResult]):
+        if not has_results(results):
+            await self.finish_text(empty_results_text(results))
+            return
+        await self._stop_edits()
+        stored = StoredResult(self.query, self.owner_id, results)
+        rid = await store_results(stored)
+        content, markup = result_page(rid, stored, first_page(stored), 0)
+        await self._edit(content, markup)
+
+    async def finish_text(self, text: str):
+        await self._stop_edits()
+        await self._edit(Text(text))
@@ -19,16 +19,13 @@ from aiogram.types import (
     ReplyKeyboardRemove,
 )
 
-from aiogram.utils.formatting import (
-    Bold,
-    as_key_value,
-    as_list,
-    as_numbered_list,
-    as_section,
-)
+from aiogram.utils.formatting import as_key_value
 
+import errors
 import settings
-from main import search_google, mobile_agent, desktop_agent
+from search import search_profiles, has_results, empty_results_text, search_content, quota_exceeded_text, start_http_client, close_http_client
+
+logger = logging.getLogger(__name__)
 
 BUTTON_CANCEL = KeyboardButton(text="❌ Cancel")
 BUTTON_BACK = KeyboardButton(text="🔙 Back")
@@ -139,26 +136,18 @@ class NameScene(CancellableScene, state="name"):
         data: FSMData = await self.wizard.get_data()
         name = data.get("name", "Anonymous")
         await message.answer("Sedang mencari . . . ")
-        mobile_search_result = await search_google(name, mobile_agent)
-        desktop_search_result = await search_google(name, desktop_agent)
-        print("mencari : ", name)
+        try:
+            results = await search_profiles(name, user_id=message.from_user.id)
+        except errors.QuotaExceeded as e:
+            await message.answer(quota_exceeded_text(e))
+            return
+        logger.debug("mencari : %s", name)
 
-        if not mobile_search_result and not mobile_search_result:
-            await message.answer("Tidak ada hasil ")
+        if not has_results(results):
+            await message.answer(empty_results_text(results))
             return
 
-        content = as_list(
-            as_section(
-                Bold("Mobile Result:\n"),
-                as_numbered_list(*mobile_search_result),
-            ),
-            "",
-            as_section(
-                Bold("Desktop Result:\n"),
-                as_numbered_list(*desktop_search_result),
-            ),
-            "",
-        )
+        content = search_content(results)
         await message.answer(**content.as_kwargs(), reply_markup=ReplyKeyboardRemove())
 
     @on.message(after=After.goto(LikeBotsScene))
@@ -217,6 +206,8 @@ class DefaultScene(
 
 def create_dispatcher() -> Dispatcher:
     dispatcher = Dispatcher()
+    dispatcher.startup.register(start_http_client)
+    dispatcher.shutdown.register(close_http_client)
 
     # Scene registry should be the only one instance in your application for proper work.
     # It stores all available scenes.
@@ -0,0 +1,214 @@
+"""
+Background runs of saved search commands.
+
+A `CommandSearch` with `schedule_minutes` set is searched again every period and its owner is
+only told about links that earlier runs have not seen. The scheduler claims a due command by moving
+its `next_run_at` forward, so several bot processes never run the same command twice. Runs are
+bounded by SCHEDULER_CONCURRENCY and charged to the bot's daily API quota rather than the owner's
+share, and they stop while that quota is down to its reserve for interactive searches. Links only
+count as seen once the message announcing them was sent.
+"""
+import asyncio
+import hashlib
+import logging
+import random
+import time
+
+from aiogram import Bot
+from aiogram.utils.formatting import Bold, Text, as_list, as_numbered_list
+
+import errors
+import settings
+from database import CommandSearch, claim_scheduled_command, due_scheduled_commands, save_seen_links
+from outbox import MAX_MESSAGE_LENGTH
+from quota import quota
+from search import DESKTOP_PROFILE, SearchItem, page_starts, search_profiles
+from throttling import background_sends
+
+logger = logging.getLogger(__name__)
+
+# Both profiles mostly return the same links, one is enough to notice new ones.
+SCHEDULED_PROFILES = (DESKTOP_PROFILE,)
+
+_HASH_SIZE = 8
+
+
+class SeenLinks:
+    """
+    Fixed size hashes of the links a command has seen, oldest first.
+
+    8 bytes of blake2b per link keeps a few hundred links in a few kilobytes, and a false match
+    between two different links is not a practical concern at that size.
+    """
+
+    def __init__(self, blob: bytes | None, limit: int):
+        blob = blob or b""
+        self.hashes = [blob[i:i + _HASH_SIZE] for i in range(0, len(blob), _HASH_SIZE)]
+        self._known = set(self.hashes)
+        self.limit = limit
+
+    @staticmethod
+    def hash(link: str) -> bytes:
+        return hashlib.blake2b(link.encode(), digest_size=_HASH_SIZE).digest()
+
+    def __bool__(self) -> bool:
+        return bool(self.hashes)
+
+    def __contains__(self, link: str) -> bool:
+        return self.hash(link) in self._known
+
+    def add(self, link: str) -> bool:
+        digest = self.hash(link)
+        if digest in self._known:
+            return False
+        self.hashes.append(digest)
+        self._known.add(digest)
+        return True
+
+    def to_bytes(self) -> bytes:
+        return b"".join(self.hashes[-self.limit:])
+
+
+def next_run(cmd: CommandSearch, now: int) -> int:
+    period = cmd.schedule_minutes * 60
+    return now + period + int(random.uniform(0, period * settings.SCHEDULER_JITTER))
+
+
+def _new_links_content(header: str, texts: list[str], start: int) -> Text:
+    return as_list(Bold(header), as_numbered_list(*texts, start=start))
+
+
+def new_links_messages(cmd: CommandSearch, items: list[SearchItem]) -> list[tuple[Text, list[SearchItem]]]:
+    """
+    Messages announcing `items`, as (content, items) pairs split to fit Telegram's length limit.
+    """
+    header = f"Link baru untuk {cmd.command} ({cmd.keyword}):\n"
+    # Room for the header and the number of one item.
+    item_limit = MAX_MESSAGE_LENGTH - len(header) - 16
+    messages = []
+    texts: list[str] = []
+    group: list[SearchItem] = []
+    start = 1
+    for item in items:
+        text = item.as_text()[:item_limit]
+        if group and len(_new_links_content(header, texts + [text], start).render()[0]) > MAX_MESSAGE_LENGTH:
+            messages.append((_new_links_content(header, texts, start), group))
+            start += len(group)
+            texts, group = [], []
+        texts.append(text)
+        group.append(item)
+    if group:
+        messages.append((_new_links_content(header, texts, start), group))
+    return messages
+
+
+class SearchScheduler:
+    def __init__(self, bot: Bot, interval: float = settings.SCHEDULER_INTERVAL,
+                 batch_size: int = settings.SCHEDULER_BATCH_SIZE,
+                 concurrency: int = settings.SCHEDULER_CONCURRENCY):
+        self.bot = bot
+        self.interval = interval
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop(), name="search-scheduler")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("scheduled search tick failed")
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    async def _has_quota() -> bool:
+        calls = len(SCHEDULED_PROFILES) * len(page_starts(settings.SEARCH_DEPTH))
+        return await quota.remaining_today() - calls >= settings.SCHEDULER_QUOTA_RESERVE
+
+    async def tick(self) -> int:
+        """
+        Run the commands that are due, returns how many ran.
+        """
+        if not await self._has_quota():
+            return 0
+        now = int(time.time())
+        due = await due_scheduled_commands(now, self.batch_size)
+        claimed = []
+        for telegram_id, cmd in due:
+            if await claim_scheduled_command(cmd.id, cmd.next_run_at, next_run(cmd, now)):
+                claimed.append((telegram_id, cmd))
+        await asyncio.gather(*(self._run(telegram_id, cmd) for telegram_id, cmd in claimed))
+        return len(claimed)
+
+    async def _run(self, telegram_id: int, cmd: CommandSearch):
+        async with self.semaphore:
+            # Checked again, the runs before this one used quota too.
+            if not await self._has_quota():
+                logger.info("skipping scheduled %s of %s, daily quota is at its reserve", cmd.command, telegram_id)
+                return
+            try:
+                # Charged to the bot, an hourly command would use up the owner's share for /cari.
+                results = await search_profiles(cmd.keyword, SCHEDULED_PROFILES)
+            except errors.QuotaExceeded as e:
+                logger.info("skipping scheduled %s of %s: %s", cmd.command, telegram_id, e)
+                return
+            if all(result.failed or result.timed_out for result in results):
+                # The next run tries again, a failed API is not "no new links".
+                logger.info("scheduled %s of %s failed, Google did not answer", cmd.command, telegram_id)
+                return
+            items = [item for result in results if result.items for item in result.items]
+
+            seen = SeenLinks(cmd.seen_links, settings.SCHEDULER_SEEN_LINKS)
+            new_items = list({item.link: item for item in items if item.link not in seen}.values())
+            if not new_items:
+                return
+            if not seen:
+                # The first run only records the links that already exist.
+                for item in new_items:
+                    seen.add(item.link)
+                await save_seen_links(cmd.id, seen.to_bytes())
+                return
+            for content, group in new_links_messages(cmd, new_items):
+                try:
+                    with background_sends():
+                        await self.bot.send_message(telegram_id, **content.as_kwargs())
+                except Exception as e:
+                    # Not marked as seen, the next run announces them again.
+                    logger.warning("could not send new links of %s to %s: %r", cmd.command, telegram_id, e)
+                    return
+                for item in group:
+                    seen.add(item.link)
+                await save_seen_links(cmd.id, seen.to_bytes())
+
+
+scheduler: SearchScheduler | None = None
+
+
+def start_scheduler(bot: Bot):
+    global scheduler
+    if not settings.SCHEDULER_ENABLED:
+        return
+    scheduler = SearchScheduler(bot)
+    scheduler.start()
+
+
+async def stop_scheduler():
+    global scheduler
+    if scheduler is not None:
+        await scheduler.stop()
+        scheduler = None
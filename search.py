@@ -0,0 +1,346 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, NamedTuple
+
+import aiohttp
+from aiogram.utils.formatting import Bold, Text, as_list, as_numbered_list, as_section
+
+import errors
+import settings
+from cache import SingleFlight, TTLCache
+from metrics import SEARCH_LATENCY, count_error
+from quota import quota
+from resilience import RetryableError, call_with_retries, google_breaker
+
+logger = logging.getLogger(__name__)
+
+mobile_agent = 'Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1'
+desktop_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.85 Safari/537.36'
+
+
+class SearchItem(NamedTuple):
+    title: str
+    link: str
+
+    def as_text(self) -> str:
+        return self.title + " \nlink :" + self.link
+
+
+@dataclass(frozen=True)
+class SearchProfile:
+    name: str
+    user_agent: str
+    gl: str = "id"
+    lr: str = "lang_id"
+
+
+@dataclass
+class ProfileResult:
+    profile: SearchProfile
+    items: list[SearchItem] | None = None
+    timed_out: bool = False
+    pages_fetched: int = 0
+    # The API failed, as opposed to answering without results.
+    failed: bool = False
+    # The API refused the query itself (HTTP 400), asking again would not help.
+    rejected: bool = False
+
+
+MOBILE_PROFILE = SearchProfile("Mobile", mobile_agent)
+DESKTOP_PROFILE = SearchProfile("Desktop", desktop_agent)
+DEFAULT_PROFILES = (MOBILE_PROFILE, DESKTOP_PROFILE)
+
+GOOGLE_SEARCH_URL = settings.GOOGLE_SEARCH_URL
+# The API returns at most 10 items per call and serves nothing past the 100th result.
+GOOGLE_PAGE_SIZE = 10
+GOOGLE_MAX_DEPTH = 100
+
+# Google APIs only serve gzip bodies when the client user agent mentions gzip.
+HTTP_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "User-Agent": "google_search_tg_bot (gzip)",
+}
+
+_http_session: aiohttp.ClientSession | None = None
+
+
+def _results_size(items: list[SearchItem]) -> int:
+    return sum(len(item.title) + len(item.link) for item in items) + 64
+
+
+search_cache = TTLCache(
+    ttl=settings.SEARCH_CACHE_TTL,
+    max_entries=settings.SEARCH_CACHE_MAX_ENTRIES,
+    max_bytes=settings.SEARCH_CACHE_MAX_BYTES,
+    sizeof=_results_size,
+)
+search_inflight = SingleFlight()
+
+
+async def start_http_client() -> aiohttp.ClientSession:
+    """
+    Create the shared HTTP client, reused by every search for keep-alive connection pooling.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=settings.HTTP_POOL_SIZE,
+            limit_per_host=settings.HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=settings.GOOGLE_CONNECT_TIMEOUT,
+            sock_read=settings.GOOGLE_READ_TIMEOUT,
+        )
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers=HTTP_HEADERS,
+            auto_decompress=True,
+        )
+    return _http_session
+
+
+async def close_http_client() -> None:
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+
+def _cache_key(query, user_agent, gl, lr, start=1) -> tuple:
+    return normalize_query(query), user_agent, gl, lr, start
+
+
+def page_starts(depth: int) -> list[int]:
+    """
+    `start` of every API page needed for `depth` results.
+    """
+    depth = min(max(depth, 1), GOOGLE_MAX_DEPTH)
+    return list(range(1, depth + 1, GOOGLE_PAGE_SIZE))
+
+
+async def search_google(query, user_agent, gl="id", lr="lang_id", start=1) -> list[SearchItem]:
+    """
+    One page of results, raises errors.SearchUnavailable when the API failed
+    and errors.SearchRejected when it refused the search.
+    """
+    key = _cache_key(query, user_agent, gl, lr, start)
+    items = search_cache.get(key)
+    if items is not None:
+        return items
+
+    return await search_inflight.do(key, _fetch_and_cache, key, query, user_agent, gl, lr, start)
+
+
+async def _fetch_and_cache(key, query, user_agent, gl, lr, start):
+    items = await _fetch_google(query, user_agent, gl, lr, start)
+    search_cache.set(key, items)
+    return items
+
+
+async def _fetch_google(query, user_agent, gl, lr, start):
+    params = {
+        "key": settings.GOOGLE_API,
+        "cx": settings.GOOGLE_CX,
+        "q": query,
+        "gl": gl,
+        "userAgent": user_agent,
+        "lr": lr,
+        "start": start,
+        "num": GOOGLE_PAGE_SIZE,
+        # "cr": "countryID",
+    }
+
+    return await call_with_retries(lambda: _request_google(params), google_breaker)
+
+
+async def _request_google(params: dict) -> list[SearchItem]:
+    session = await start_http_client()
+    async with session.get(GOOGLE_SEARCH_URL, params=params) as response:
+        if response.status == 429 or response.status >= 500:
+            raise RetryableError(f"HTTP {response.status}")
+        if response.status >= 400:
+            raise errors.SearchRejected(response.status)
+        data = await response.json()
+    items = data.get("items", [])
+    return [SearchItem(item.get("title", ""), item.get("link", "")) for item in items]
+
+
+async def _observed_search(query, profile: SearchProfile, start: int):
+    """
+    One page of results, or the errors.SearchUnavailable / errors.SearchRejected raised instead.
+    """
+    cached = _cache_key(query, profile.user_agent, profile.gl, profile.lr, start) in search_cache
+    started = time.perf_counter()
+    try:
+        return await search_google(query, profile.user_agent, gl=profile.gl, lr=profile.lr, start=start)
+    except (errors.SearchUnavailable, errors.SearchRejected) as e:
+        return e
+    finally:
+        SEARCH_LATENCY.labels(profile.name, "hit" if cached else "miss").observe(time.perf_counter() - started)
+
+
+def _needs_call(query, profile: SearchProfile, start: int) -> bool:
+    key = _cache_key(query, profile.user_agent, profile.gl, profile.lr, start)
+    return key not in search_cache and key not in search_inflight
+
+
+def _merge_pages(pages: list[list[SearchItem]], depth: int) -> list[SearchItem]:
+    # Pages overlap when the index changes between calls, keep the best ranked copy of a link.
+    items = []
+    seen = set()
+    for page in pages:
+        for item in page:
+            if item.link not in seen:
+                seen.add(item.link)
+                items.append(item)
+    return items[:depth]
+
+
+async def search_profiles(
+        query,
+        profiles=DEFAULT_PROFILES,
+        deadline: float | None = None,
+        user_id: int | None = None,
+        depth: int | None = None,
+        on_progress: Callable[[ProfileResult], None] | None = None,
+) -> list[ProfileResult]:
+    """
+    Run the search for every profile at the same time and wait at most `deadline` seconds.
+
+    The `depth` results of a profile come from several API pages, all requested at once and
+    merged in rank order. Pages that did not answer in time are left out, a profile whose first
+    page did not answer is returned with `timed_out=True`.
+    Every page that has to call the API is charged to `user_id` up front,
+    so a mobile/desktop pair costs two calls per page; raises errors.QuotaExceeded when over budget.
+    When the user's share left for today cannot pay for `depth`, fewer pages are fetched.
+    Nothing is charged while the circuit breaker fails calls fast, a profile whose first page
+    failed is returned with `failed=True`, or `rejected=True` when the API refused it.
+    `on_progress` is called with the result of each profile as soon as all of its pages are in.
+    """
+    if deadline is None:
+        deadline = settings.SEARCH_DEADLINE
+    if depth is None:
+        depth = settings.SEARCH_DEPTH
+    starts = page_starts(depth)
+    # API calls needed for each page, over all profiles.
+    page_calls = [sum(_needs_call(query, profile, start) for profile in profiles) for start in starts]
+    if not google_breaker.allows_calls():
+        page_calls = [0] * len(starts)
+    calls = sum(page_calls)
+    if user_id is not None and len(starts) > 1 and calls > page_calls[0]:
+        remaining = await quota.remaining_today(user_id)
+        while len(starts) > 1 and calls > remaining:
+            # A shallower search rather than none, the first page is always asked for.
+            starts = starts[:-1]
+            calls -= page_calls.pop()
+        depth = min(depth, len(starts) * GOOGLE_PAGE_SIZE)
+    try:
+        await quota.acquire(user_id, calls)
+    except errors.QuotaExceeded as e:
+        count_error(e, "search")
+        raise
+
+    tasks = {
+        (profile, start): asyncio.create_task(_observed_search(query, profile, start))
+        for profile in profiles
+        for start in starts
+    }
+    loop = asyncio.get_running_loop()
+    ends_at = loop.time() + deadline
+    pending = set(tasks.values())
+    settled = []
+    while pending:
+        if on_progress is None:
+            done, pending = await asyncio.wait(pending, timeout=deadline)
+            break
+        done, pending = await asyncio.wait(
+            pending, timeout=max(ends_at - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED
+        )
+        if not done:
+            break
+        for profile in profiles:
+            if profile not in settled and all(tasks[profile, start].done() for start in starts):
+                settled.append(profile)
+                on_progress(_profile_result(query, profile, starts, tasks, depth))
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return [_profile_result(query, profile, starts, tasks, depth) for profile in profiles]
+
+
+def _profile_result(query, profile: SearchProfile, starts: list[int], tasks: dict, depth: int) -> ProfileResult:
+    pages = []
+    for start in starts:
+        task = tasks[profile, start]
+        if not task.done() or task.cancelled() or isinstance(task.result(), Exception):
+            # Later pages are only useful after the ones ranked before them.
+            break
+        pages.append(task.result())
+        if len(task.result()) < GOOGLE_PAGE_SIZE:
+            break
+    first = tasks[profile, starts[0]]
+    if not first.done() or first.cancelled():
+        logger.warning("search %r timed out for profile %s", query, profile.name)
+        return ProfileResult(profile, timed_out=True)
+    if not pages:
+        if isinstance(first.result(), errors.SearchRejected):
+            return ProfileResult(profile, rejected=True)
+        return ProfileResult(profile, failed=True)
+    return ProfileResult(profile, items=_merge_pages(pages, depth), pages_fetched=len(pages))
+
+
+def quota_exceeded_text(error: errors.QuotaExceeded) -> str:
+    if isinstance(error, errors.UserQuotaExceeded):
+        return "Jatah pencarian anda untuk hari ini sudah habis, silahkan coba lagi besok"
+    if isinstance(error, errors.SearchRateLimited):
+        return "Terlalu banyak pencarian saat ini, silahkan coba lagi sebentar lagi"
+    return "Kuota pencarian Google hari ini sudah habis, silahkan coba lagi besok"
+
+
+def has_results(results: list[ProfileResult]) -> bool:
+    return any(result.items for result in results)
+
+
+def empty_results_text(results: list[ProfileResult]) -> str:
+    """
+    Reply for a search without results, telling a failed API apart from a search that found nothing.
+    """
+    if any(result.failed for result in results):
+        return "Pencarian Google sedang bermasalah, silahkan coba lagi nanti"
+    if any(result.rejected for result in results):
+        return "Pencarian ditolak oleh Google, silahkan coba dengan kata kunci lain"
+    if any(result.timed_out for result in results):
+        return "Waktu pencarian habis, silahkan coba lagi"
+    return "Tidak ada hasil "
+
+
+def search_content(results: list[ProfileResult]) -> Text:
+    sections = []
+    for result in results:
+        if result.timed_out:
+            body = "Waktu pencarian habis"
+        elif result.failed:
+            body = "Pencarian Google gagal"
+        elif result.rejected:
+            body = "Pencarian ditolak oleh Google"
+        elif not result.items:
+            body = "Tidak ada hasil"
+        else:
+            body = as_numbered_list(*[item.as_text() for item in result.items])
+        header = f"{result.profile.name} Result"
+        if result.pages_fetched:
+            header += f" ({result.pages_fetched} halaman)"
+        sections.append(as_section(Bold(f"{header}:\n"), body))
+        sections.append("")
+    return as_list(*sections)
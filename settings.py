@@ -6,11 +6,158 @@ load_dotenv()
 TELEGRAM_API = getenv("TELEGRAM_API")
 GOOGLE_CX = getenv("GOOGLE_CX")
 GOOGLE_API = getenv("GOOGLE_API")
+# Overridden by the benchmarks, which serve a local stub of the API
+GOOGLE_SEARCH_URL = getenv("GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
 
 DB_HOST = getenv("DB_HOST")
 DB_PORT = getenv("DB_PORT")
 DB_NAME = getenv("DB_NAME")
 DB_USER = getenv("DB_USER")
 DB_PASSWORD = getenv("DB_PASSWORD")
+# SQLAlchemy URL of the database, used instead of the DB_* settings when set,
+# e.g. sqlite+aiosqlite:///bot.db. sqlite+aiosqlite:///:memory: is for tests and benchmarks only:
+# the database lives in one connection shared by every session, so queries run one at a time
+# and everything is lost when the process exits.
+DATABASE_URL = getenv("DATABASE_URL")
 
 ADMIN_USER_ID = getenv("ADMIN_USER_ID")
+
+GOOGLE_CONNECT_TIMEOUT = float(getenv("GOOGLE_CONNECT_TIMEOUT", "3"))
+GOOGLE_READ_TIMEOUT = float(getenv("GOOGLE_READ_TIMEOUT", "10"))
+# Seconds for one API request, and for all attempts of a call together
+GOOGLE_ATTEMPT_TIMEOUT = float(getenv("GOOGLE_ATTEMPT_TIMEOUT", "4"))
+GOOGLE_TOTAL_TIMEOUT = float(getenv("GOOGLE_TOTAL_TIMEOUT", "8"))
+# Retries of a call answered with HTTP 5xx or 429, the delay doubles from GOOGLE_RETRY_DELAY
+GOOGLE_MAX_RETRIES = int(getenv("GOOGLE_MAX_RETRIES", "2"))
+GOOGLE_RETRY_DELAY = float(getenv("GOOGLE_RETRY_DELAY", "0.25"))
+GOOGLE_MAX_RETRY_DELAY = float(getenv("GOOGLE_MAX_RETRY_DELAY", "2"))
+# Failed calls in a row before the API is skipped for GOOGLE_BREAKER_RESET seconds
+GOOGLE_BREAKER_THRESHOLD = int(getenv("GOOGLE_BREAKER_THRESHOLD", "5"))
+GOOGLE_BREAKER_RESET = float(getenv("GOOGLE_BREAKER_RESET", "30"))
+
+HTTP_POOL_SIZE = int(getenv("HTTP_POOL_SIZE", "100"))
+HTTP_POOL_SIZE_PER_HOST = int(getenv("HTTP_POOL_SIZE_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+
+SEARCH_DEADLINE = float(getenv("SEARCH_DEADLINE", "8"))
+# Results per profile, fetched 10 per API call (at most 100)
+SEARCH_DEPTH = int(getenv("SEARCH_DEPTH", "10"))
+
+SEARCH_CACHE_TTL = float(getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(getenv("SEARCH_CACHE_MAX_ENTRIES", "2000"))
+SEARCH_CACHE_MAX_BYTES = int(getenv("SEARCH_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Search results kept for paging with the inline buttons
+RESULT_PAGE_SIZE = int(getenv("RESULT_PAGE_SIZE", "5"))
+RESULT_TTL = float(getenv("RESULT_TTL", "3600"))
+RESULT_MAX_ENTRIES = int(getenv("RESULT_MAX_ENTRIES", "10000"))
+RESULT_MAX_BYTES = int(getenv("RESULT_MAX_BYTES", str(32 * 1024 * 1024)))
+# Seconds between deletions of expired results from the search_result table
+RESULT_PURGE_INTERVAL = float(getenv("RESULT_PURGE_INTERVAL", "3600"))
+# Seconds between two edits of the "Mencari . . ." message while results come in
+EDIT_MIN_INTERVAL = float(getenv("EDIT_MIN_INTERVAL", "1"))
+
+GOOGLE_DAILY_QUOTA = int(getenv("GOOGLE_DAILY_QUOTA", "100"))
+GOOGLE_USER_DAILY_QUOTA = int(getenv("GOOGLE_USER_DAILY_QUOTA", "20"))
+GOOGLE_MINUTE_QUOTA = int(getenv("GOOGLE_MINUTE_QUOTA", "60"))
+GOOGLE_QUOTA_MAX_WAIT = float(getenv("GOOGLE_QUOTA_MAX_WAIT", "5"))
+
+DB_POOL_SIZE = int(getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PRE_PING = getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(getenv("DB_POOL_RECYCLE", "1800"))
+
+AUTH_CACHE_TTL = float(getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_NEGATIVE_TTL = float(getenv("AUTH_CACHE_NEGATIVE_TTL", "10"))
+AUTH_CACHE_MAX_ENTRIES = int(getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+COMMAND_INDEX_TTL = float(getenv("COMMAND_INDEX_TTL", "600"))
+COMMAND_INDEX_MAX_USERS = int(getenv("COMMAND_INDEX_MAX_USERS", "50000"))
+COMMAND_INDEX_WARMUP = getenv("COMMAND_INDEX_WARMUP", "false").lower() in ("1", "true", "yes")
+# Seconds between checks for users changed by other bot processes, 0 turns it off (single process only)
+CACHE_SYNC_INTERVAL = float(getenv("CACHE_SYNC_INTERVAL", "1"))
+# Seconds a transaction may take to commit after it recorded a change
+CACHE_SYNC_SLACK = int(getenv("CACHE_SYNC_SLACK", "5"))
+
+USER_PAGE_SIZE = int(getenv("USER_PAGE_SIZE", "20"))
+USER_COUNT_TTL = float(getenv("USER_COUNT_TTL", "300"))
+
+# "polling" or "webhook"
+BOT_MODE = getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = getenv("WEBHOOK_BASE_URL", "")
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_MAX_CONNECTIONS = int(getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# "sql" keeps scene state in the database, "memory" in the process (single instance only)
+FSM_STORAGE = getenv("FSM_STORAGE", "sql")
+FSM_TTL = int(getenv("FSM_TTL", str(7 * 24 * 3600)))
+FSM_FLUSH_INTERVAL = float(getenv("FSM_FLUSH_INTERVAL", "0.02"))
+# Longest wait between flush retries while the database is unreachable
+FSM_FLUSH_MAX_DELAY = float(getenv("FSM_FLUSH_MAX_DELAY", "5"))
+# Connections of the FSM storage, a pool separate from the one of the database helpers
+FSM_POOL_SIZE = int(getenv("FSM_POOL_SIZE", "5"))
+FSM_MAX_OVERFLOW = int(getenv("FSM_MAX_OVERFLOW", "10"))
+FSM_PURGE_INTERVAL = float(getenv("FSM_PURGE_INTERVAL", "3600"))
+
+DB_CONNECT_ATTEMPTS = int(getenv("DB_CONNECT_ATTEMPTS", "10"))
+DB_CONNECT_DELAY = float(getenv("DB_CONNECT_DELAY", "0.5"))
+DB_CONNECT_MAX_DELAY = float(getenv("DB_CONNECT_MAX_DELAY", "10"))
+# Run schema migrations at startup, otherwise run `python migrations.py` before deploying
+DB_AUTO_MIGRATE = getenv("DB_AUTO_MIGRATE", "false").lower() in ("1", "true", "yes")
+
+# Seconds the startup may take before a warning is logged
+STARTUP_BUDGET = float(getenv("STARTUP_BUDGET", "5"))
+# Created once the bot is ready to serve updates, removed on shutdown
+READY_FILE = getenv("READY_FILE", "")
+
+# Background runs of saved commands that have a schedule
+SCHEDULER_ENABLED = getenv("SCHEDULER_ENABLED", "true").lower() in ("1", "true", "yes")
+# Seconds between checks for due commands
+SCHEDULER_INTERVAL = float(getenv("SCHEDULER_INTERVAL", "60"))
+SCHEDULER_BATCH_SIZE = int(getenv("SCHEDULER_BATCH_SIZE", "50"))
+SCHEDULER_CONCURRENCY = int(getenv("SCHEDULER_CONCURRENCY", "4"))
+# Each next run is pushed back by up to this fraction of the period, so runs do not bunch up
+SCHEDULER_JITTER = float(getenv("SCHEDULER_JITTER", "0.1"))
+SCHEDULER_MIN_MINUTES = int(getenv("SCHEDULER_MIN_MINUTES", "60"))
+# Daily API calls left for interactive searches, scheduled runs stop below it
+SCHEDULER_QUOTA_RESERVE = int(getenv("SCHEDULER_QUOTA_RESERVE", "30"))
+# Link hashes remembered per command
+SCHEDULER_SEEN_LINKS = int(getenv("SCHEDULER_SEEN_LINKS", "500"))
+
+# Outgoing Telegram requests are throttled to stay under the flood limits
+SEND_THROTTLE = getenv("SEND_THROTTLE", "true").lower() in ("1", "true", "yes")
+SEND_GLOBAL_RATE = float(getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(getenv("SEND_CHAT_BURST", "3"))
+SEND_GROUP_PER_MINUTE = float(getenv("SEND_GROUP_PER_MINUTE", "20"))
+# Retries of a request rejected with RetryAfter
+SEND_MAX_RETRIES = int(getenv("SEND_MAX_RETRIES", "3"))
+
+# Admin notifications are delivered from the admin_outbox table every OUTBOX_INTERVAL seconds
+OUTBOX_INTERVAL = float(getenv("OUTBOX_INTERVAL", "5"))
+OUTBOX_BATCH_SIZE = int(getenv("OUTBOX_BATCH_SIZE", "50"))
+# Seconds a worker holds notices it is delivering
+OUTBOX_LEASE = int(getenv("OUTBOX_LEASE", "60"))
+# First retry delay in seconds, doubled after every failure up to OUTBOX_MAX_RETRY_DELAY
+OUTBOX_RETRY_DELAY = int(getenv("OUTBOX_RETRY_DELAY", "10"))
+OUTBOX_MAX_RETRY_DELAY = int(getenv("OUTBOX_MAX_RETRY_DELAY", "3600"))
+
+# Port of the /metrics endpoint in polling mode, 0 disables it (the webhook app serves /metrics itself)
+METRICS_PORT = int(getenv("METRICS_PORT", "0"))
+METRICS_HOST = getenv("METRICS_HOST", "0.0.0.0")
+
+# Profiling of updates, also switched at runtime by the admin with /profiler on|off
+PROFILER_ENABLED = getenv("PROFILER_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILER_DIR = getenv("PROFILER_DIR", "profiles")
+# Fraction of updates profiled with cProfile
+PROFILER_SAMPLE_RATE = float(getenv("PROFILER_SAMPLE_RATE", "0.01"))
+# Updates slower than this many seconds are written as collapsed stacks
+PROFILER_SLOW_THRESHOLD = float(getenv("PROFILER_SLOW_THRESHOLD", "1"))
+# Seconds between two stack samples
+PROFILER_INTERVAL = float(getenv("PROFILER_INTERVAL", "0.005"))
+PROFILER_MAX_FILES = int(getenv("PROFILER_MAX_FILES", "200"))
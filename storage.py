@@ -0,0 +1,206 @@
+"""
+Shared FSM storage for the scene wizard.
+
+Scene state and wizard data live in the `fsm_state` table, so they survive restarts and every
+bot process sees the same state. Writes are coalesced per key and flushed in one batch shortly after
+they happen. Entries expire FSM_TTL seconds after they were last used: reading an entry that is
+past half of its TTL extends it with the next flush. The storage has an engine and pool of its own
+(database.get_fsm_engine), so reading a state never waits for a connection held by an update.
+Wizard data is stored as zlib-compressed JSON, like the stored search results (results.py).
+"""
+import asyncio
+import json
+import logging
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import settings
+from database import FsmState, get_fsm_engine
+
+logger = logging.getLogger(__name__)
+
+_table = FsmState.__table__
+
+
+def _dump(data: Dict[str, Any]) -> bytes | None:
+    if not data:
+        return None
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+
+
+def _load(blob: bytes | None) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    try:
+        try:
+            blob = zlib.decompress(blob)
+        except zlib.error:
+            # Plain JSON, written before the data was compressed.
+            pass
+        return json.loads(blob)
+    except ValueError:
+        # Written by an older release, or not ours. The user starts the wizard again.
+        logger.warning("dropping unreadable FSM data")
+        return {}
+
+
+class SQLStorage(BaseStorage):
+    def __init__(self, engine: AsyncEngine, ttl: int, flush_interval: float, purge_interval: float,
+                 max_flush_delay: float = settings.FSM_FLUSH_MAX_DELAY):
+        self.engine = engine
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.max_flush_delay = max_flush_delay
+        self.purge_interval = purge_interval
+        # Records written but not flushed yet, as {key: (state, data)}.
+        self._pending: dict[str, tuple[Optional[str], Dict[str, Any]]] = {}
+        self._flushing: dict[str, tuple[Optional[str], Dict[str, Any]]] = {}
+        # Keys read past half of their TTL, their expiry is extended with the next flush.
+        self._touched: set[str] = set()
+        self._flush_task: asyncio.Task | None = None
+        self._last_purge = time.monotonic()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _read(self, key: str) -> tuple[Optional[str], Dict[str, Any]]:
+        record = self._pending.get(key) or self._flushing.get(key)
+        if record is not None:
+            state, data = record
+            return state, data.copy()
+        async with self.engine.connect() as conn:
+            now = int(time.time())
+            row = (await conn.execute(
+                select(_table.c.state, _table.c.data, _table.c.expires_at).where(
+                    _table.c.key == key, _table.c.expires_at > now
+                )
+            )).first()
+        if row is None:
+            return None, {}
+        if row.expires_at - now < self.ttl / 2:
+            self._touched.add(key)
+            self._schedule_flush()
+        return row.state, _load(row.data)
+
+    def _write(self, key: str, state: Optional[str], data: Dict[str, Any]) -> None:
+        self._pending[key] = (state, data)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        delay = self.flush_interval
+        while self._pending or self._touched:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                delay = self.flush_interval
+            except Exception as e:
+                # The records stay pending, back off while the database is unreachable.
+                delay = min(max(delay * 2, 0.5), self.max_flush_delay)
+                logger.warning("failed to flush %d FSM records: %r, retrying in %.1fs", len(self._pending), e, delay)
+
+    async def flush(self) -> None:
+        if not self._pending and not self._touched:
+            return
+        pending, self._pending = self._pending, {}
+        # A pending write sets the expiry anyway.
+        touched, self._touched = self._touched - pending.keys(), set()
+        self._flushing = pending
+        expires_at = int(time.time()) + self.ttl
+        upserts = []
+        deletes = []
+        for key, (state, data) in pending.items():
+            if state is None and not data:
+                deletes.append(key)
+            else:
+                upserts.append({"key": key, "state": state, "data": _dump(data), "expires_at": expires_at})
+        try:
+            async with self.engine.begin() as conn:
+                if deletes:
+                    await conn.execute(delete(_table).where(_table.c.key.in_(deletes)))
+                if upserts:
+                    await conn.execute(self._upsert_statement(conn.dialect.name), upserts)
+                if touched:
+                    await conn.execute(
+                        update(_table).where(_table.c.key.in_(touched)).values(expires_at=expires_at)
+                    )
+                if time.monotonic() - self._last_purge > self.purge_interval:
+                    self._last_purge = time.monotonic()
+                    await conn.execute(delete(_table).where(_table.c.expires_at <= int(time.time())))
+        except BaseException:
+            # Keep newer writes that arrived while flushing, retry the rest with the next flush.
+            for key, record in pending.items():
+                self._pending.setdefault(key, record)
+            self._touched |= touched
+            raise
+        finally:
+            self._flushing = {}
+
+    @staticmethod
+    def _upsert_statement(dialect: str):
+        if dialect == "mysql":
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(_table)
+            return stmt.on_duplicate_key_update(
+                state=stmt.inserted.state, data=stmt.inserted.data, expires_at=stmt.inserted.expires_at
+            )
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(_table)
+            return stmt.on_conflict_do_update(
+                index_elements=[_table.c.key],
+                set_={"state": stmt.excluded.state, "data": stmt.excluded.data, "expires_at": stmt.excluded.expires_at},
+            )
+        raise NotImplementedError(f"SQLStorage does not support {dialect}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        _, data = await self._read(storage_key)
+        self._write(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._read(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        state, _ = await self._read(storage_key)
+        self._write(storage_key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._read(self._key(key))
+        return data
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+
+def create_storage() -> BaseStorage:
+    if settings.FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLStorage(
+        get_fsm_engine(),
+        ttl=settings.FSM_TTL,
+        flush_interval=settings.FSM_FLUSH_INTERVAL,
+        purge_interval=settings.FSM_PURGE_INTERVAL,
+    )
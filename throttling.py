@@ -0,0 +1,229 @@
+"""
+Outgoing Telegram request throttling.
+
+`SendThrottle` is a request middleware of the bot session, so every call that targets a chat
+(replies, edits, the admin notification, scheduled notifications) goes through it, however it was
+made. Token buckets keep the bot under Telegram's limits: SEND_GLOBAL_RATE requests per second
+overall, SEND_CHAT_RATE per second in a private chat and SEND_GROUP_PER_MINUTE per minute in a
+group. Requests that have to wait are queued by priority, replies to users before background sends,
+and a request rejected with RetryAfter is queued again once the chat is allowed to send.
+The queue depth and the numbers of throttled and retried requests are exported to Prometheus.
+"""
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+import settings
+from metrics import SEND_QUEUE, SEND_RETRIES, SEND_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+send_priority: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def background_sends():
+    """
+    Requests made inside the block wait behind replies to users.
+    """
+    token = send_priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Seconds until a token is available, 0 when one can be taken now.
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    chat_id: int | str = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class SendThrottle(BaseRequestMiddleware):
+    # Idle chat buckets are dropped once there are more than this many.
+    MAX_IDLE_CHATS = 10000
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int,
+                 group_per_minute: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_per_minute = group_per_minute
+        self.max_retries = max_retries
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._queue: list[_Waiter] = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._pump_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _chat_key(chat_id: int | str) -> int | str:
+        # Ids may come as strings, e.g. settings.ADMIN_USER_ID; "123" and 123 are the same chat.
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            return int(chat_id)
+        return chat_id
+
+    @staticmethod
+    def _is_group(chat_id: int | str) -> bool:
+        # Groups and channels have negative ids, channels may also be given as "@username".
+        return not isinstance(chat_id, int) or chat_id < 0
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_IDLE_CHATS:
+                now = time.monotonic()
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_idle(now)}
+            if self._is_group(chat_id):
+                bucket = TokenBucket(self.group_per_minute / 60, min(self.chat_burst, self.group_per_minute))
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _wait_time(self, chat_id: int | str, now: float) -> float:
+        return max(self.global_bucket.wait_time(now), self._chat_bucket(chat_id).wait_time(now))
+
+    def _take(self, chat_id: int | str, now: float):
+        self.global_bucket.take(now)
+        self._chat_bucket(chat_id).take(now)
+
+    async def _acquire(self, chat_id: int | str, priority: int):
+        now = time.monotonic()
+        if not self._queue and self._wait_time(chat_id, now) == 0:
+            self._take(chat_id, now)
+            return
+        SEND_THROTTLED.inc()
+        self._seq += 1
+        waiter = _Waiter(priority, self._seq, chat_id, asyncio.get_running_loop().create_future())
+        self._queue.append(waiter)
+        SEND_QUEUE.set(len(self._queue))
+        self._wakeup.set()
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await waiter.future
+
+    async def _pump(self):
+        while self._queue:
+            self._wakeup.clear()
+            now = time.monotonic()
+            soonest = None
+            for waiter in sorted(self._queue):
+                if waiter.future.done():
+                    # Cancelled while waiting.
+                    self._queue.remove(waiter)
+                    continue
+                wait = self._wait_time(waiter.chat_id, now)
+                if wait == 0:
+                    self._take(waiter.chat_id, now)
+                    self._queue.remove(waiter)
+                    waiter.future.set_result(None)
+                    continue
+                soonest = wait if soonest is None else min(soonest, wait)
+                global_wait = self.global_bucket.wait_time(now)
+                if global_wait > 0:
+                    # Nobody else can send before the global bucket refills.
+                    soonest = min(soonest, global_wait)
+                    break
+            SEND_QUEUE.set(len(self._queue))
+            if soonest is None:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=soonest)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        chat_id = self._chat_key(chat_id)
+        priority = send_priority.get()
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                SEND_RETRIES.inc()
+                logger.warning("%s to chat %s hit the flood limit, retrying in %ss (attempt %d/%d)",
+                               type(method).__name__, chat_id, e.retry_after, attempt, self.max_retries)
+                self._chat_bucket(chat_id).block(e.retry_after)
+                continue
+            return response
+
+
+throttle: SendThrottle | None = None
+
+
+def install_throttle(bot: Bot) -> SendThrottle:
+    global throttle
+    # Webhook workers are separate processes that share one bot token.
+    workers = settings.WEBHOOK_WORKERS if settings.BOT_MODE == "webhook" else 1
+    throttle = SendThrottle(
+        global_rate=settings.SEND_GLOBAL_RATE / max(workers, 1),
+        chat_rate=settings.SEND_CHAT_RATE,
+        chat_burst=settings.SEND_CHAT_BURST,
+        group_per_minute=settings.SEND_GROUP_PER_MINUTE,
+        max_retries=settings.SEND_MAX_RETRIES,
+    )
+    bot.session.middleware(throttle)
+    return throttle
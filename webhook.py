@@ -0,0 +1,104 @@
+"""
+Webhook serving mode.
+
+Telegram pushes updates to an embedded aiohttp server. Each request is acknowledged as soon as
+the update is queued and is processed in the background. With WEBHOOK_WORKERS > 1 several processes
+listen on the same port (SO_REUSEPORT) and the kernel spreads the connections between them.
+
+The workers share what has to be shared through the database: the daily Google quota
+(search_quota), scene state (fsm_state), stored search results for the page buttons
+(search_result) and invalidations of the user caches (cache_invalidation, see cachesync.py).
+Rate limits that are kept in the process, the per-minute Google quota and the Telegram send rate, are split evenly
+between the workers.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+from typing import Callable
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+import bootstrap
+import settings
+from metrics import metrics_handler
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_url() -> str:
+    return settings.WEBHOOK_BASE_URL.rstrip("/") + settings.WEBHOOK_PATH
+
+
+async def readiness(request: web.Request) -> web.Response:
+    if bootstrap.is_ready():
+        return web.Response(text="ready")
+    return web.Response(status=503, text="starting")
+
+
+def create_app(dispatcher: Dispatcher, bot: Bot) -> web.Application:
+    app = web.Application()
+    app.router.add_get("/readyz", readiness)
+    app.router.add_get("/metrics", metrics_handler)
+    SimpleRequestHandler(
+        dispatcher=dispatcher,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=settings.WEBHOOK_SECRET,
+    ).register(app, path=settings.WEBHOOK_PATH)
+    # Runs the dispatcher startup/shutdown hooks together with the web app.
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def set_webhook(dispatcher: Dispatcher, bot: Bot):
+    await bot.set_webhook(
+        url=webhook_url(),
+        secret_token=settings.WEBHOOK_SECRET,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+        max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+    )
+    logger.info("webhook set to %s", webhook_url())
+    await bot.session.close()
+
+
+def serve(create_dispatcher: Callable[[], Dispatcher], create_bot: Callable[[], Bot]):
+    web.run_app(
+        create_app(create_dispatcher(), create_bot()),
+        host=settings.WEBHOOK_HOST,
+        port=settings.WEBHOOK_PORT,
+        reuse_port=settings.WEBHOOK_WORKERS > 1,
+        print=None,
+    )
+
+
+def run_webhook(create_dispatcher: Callable[[], Dispatcher], create_bot: Callable[[], Bot]):
+    if not settings.WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set in webhook mode")
+    asyncio.run(set_webhook(create_dispatcher(), create_bot()))
+
+    if settings.WEBHOOK_WORKERS <= 1:
+        serve(create_dispatcher, create_bot)
+        return
+
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=serve, args=(create_dispatcher, create_bot), name=f"webhook-worker-{number}")
+        for number in range(settings.WEBHOOK_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    logger.info("serving webhook on %s:%s with %d workers",
+                settings.WEBHOOK_HOST, settings.WEBHOOK_PORT, len(workers))
+
+    def stop(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in workers:
+        worker.join()